@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+"""Benchmarks for main.py.
+
+    python bench.py parse [--elements N] [--repeat R]
+    python bench.py serialize [--elements N] [--repeat R]
+    python bench.py pipeline [--elements N] [--depth D] [--attributes A] [--text-ratio T]
+                             [--repeat R] [--output results.json]
+    python bench.py compare baseline.json results.json [--threshold 0.1]
+    python bench.py mapformat [--elements N] [--repeat R]
+    python bench.py splice [--elements N] [--dirty D] [--repeat R]
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import io
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+
+ATTRIBUTE_NAMES = ('id', 'class', 'href', 'title', 'lang', 'dir', 'style', 'data-type',
+                   'data-label', 'data-ref')
+
+
+def synthetic_document(elements, seed=0, depth=8, attributes=3, text_ratio=0.6):
+    """ Return an XHTML-ish document (str) with roughly `elements` elements,
+        nested at most `depth` deep below <body>, each with 0 to `attributes`
+        attributes and, with probability `text_ratio`, some text.
+    """
+    rand = random.Random(seed)
+    names = ATTRIBUTE_NAMES[:max(4, attributes)]
+    names += tuple('data-a%d' % i for i in range(len(names), attributes))
+    out = ['<html>\n<body>\n']
+    count = 0
+    stack = []
+    while count < elements:
+        if stack and (len(stack) > depth or rand.random() < 0.35):
+            out.append('</%s>\n' % stack.pop())
+            continue
+        tag = rand.choice(('div', 'p', 'span', 'section', 'em', 'a', 'table', 'td'))
+        attrs = ''.join(' %s="%s"' % (key, rand.choice(('x', 'a&amp;b', 'id-%d' % count)))
+                        for key in rand.sample(names, rand.randint(0, attributes)))
+        out.append('<%s%s>' % (tag, attrs))
+        if rand.random() < text_ratio:
+            out.append(rand.choice(('text', 'a &lt; b', 'some longer sentence of text', '\n  ')))
+        stack.append(tag)
+        count += 1
+    while stack:
+        out.append('</%s>\n' % stack.pop())
+    out.append('</body>\n</html>\n')
+    return ''.join(out)
+
+
+def _time(func, repeat):
+    """ Best wall time of `repeat` calls, with the garbage collector off like timeit """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# The line numbering parser before it drove expat itself: it hooked the pure Python
+# XMLParser, which meant the C accelerator had to be disabled for the whole process.
+LEGACY_PARSE = '''
+import sys, time
+sys.modules['_elementtree'] = None
+import xml.etree.ElementTree as ET
+
+class LineNumberingParser(ET.XMLParser):
+    def _start(self, *args, **kwargs):
+        element = super(self.__class__, self)._start(*args, **kwargs)
+        element._start_line_number = self.parser.CurrentLineNumber
+        element._start_column_number = self.parser.CurrentColumnNumber
+        element._start_byte_index = self.parser.CurrentByteIndex
+        return element
+
+    def _end(self, *args, **kwargs):
+        element = super(self.__class__, self)._end(*args, **kwargs)
+        element._end_line_number = self.parser.CurrentLineNumber
+        element._end_column_number = self.parser.CurrentColumnNumber
+        element._end_byte_index = self.parser.CurrentByteIndex
+        return element
+
+document = sys.stdin.read()
+best = None
+for _ in range(int(sys.argv[1])):
+    start = time.perf_counter()
+    parser = LineNumberingParser(encoding="utf-8")
+    parser.feed(document)
+    parser.close()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+print(best)
+'''
+
+
+def bench_parse(args):
+    import main
+
+    document = synthetic_document(args.elements)
+    size = len(document.encode('utf-8')) / 1e6
+
+    legacy = subprocess.run([sys.executable, '-c', LEGACY_PARSE, str(args.repeat)],
+                            input=document, stdout=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    legacy = float(legacy.stdout)
+
+    def parse():
+        parser = main.LineNumberingParser(encoding="utf-8")
+        parser.feed(document)
+        parser.close()
+    current = _time(parse, args.repeat)
+
+    print("document: %d elements, %.1f MB" % (args.elements, size))
+    print("pure Python XMLParser hook: %.3fs (%.1f MB/s)" % (legacy, size / legacy))
+    print("expat + C TreeBuilder:      %.3fs (%.1f MB/s)" % (current, size / current))
+    print("speedup: %.2fx" % (legacy / current))
+
+
+def _recursive_serialize_xml(out, elem, qnames, namespaces, short_empty_elements):
+    """ The recursive serializer main._serialize_xml replaced, kept for comparison """
+    import main
+
+    def __writer(node, text):
+        out.write(text, node._start_line_number, node._start_column_number)
+
+    def __writer_end(node, text):
+        out.write(text, node._end_line_number, node._end_column_number)
+
+    tag = qnames[elem.tag]
+    text = elem.text
+    __writer(elem, "<" + tag)
+    items = list(elem.items())
+    if items or namespaces:
+        if namespaces:
+            for v, k in sorted(namespaces.items(), key=lambda x: x[1]):
+                if k:
+                    k = ":" + k
+                __writer(elem, " xmlns%s=\"%s\"" % (k, main._escape_attrib(v)))
+        for k, v in sorted(items):
+            __writer(elem, " %s=\"%s\"" % (qnames[k], main._escape_attrib(v)))
+    if text or len(elem) or not short_empty_elements:
+        __writer(elem, ">")
+        if text:
+            __writer(elem, main._escape_cdata(text))
+        for e in elem:
+            _recursive_serialize_xml(out, e, qnames, None, short_empty_elements)
+        __writer_end(elem, "</" + tag + ">")
+    else:
+        __writer_end(elem, " />")
+    if elem.tail:
+        __writer(elem, main._escape_cdata(elem.tail))
+
+
+def bench_serialize(args):
+    import main
+
+    document = synthetic_document(args.elements)
+    parser = main.LineNumberingParser(encoding="utf-8")
+    parser.feed(document)
+    root = parser.close()
+    qnames, namespaces = main._namespaces(root)
+
+    def serialize(serializer):
+        def run():
+            smap = main.SourceMapGenerator()
+            out = main.MappedWriter(io.StringIO().write, smap, smap.add_source("input.html"))
+            serializer(out, root, qnames, namespaces, short_empty_elements=True)
+            out.flush()
+        return run
+
+    recursive = _time(serialize(_recursive_serialize_xml), args.repeat)
+    iterative = _time(serialize(main._serialize_xml), args.repeat)
+
+    print("document: %d elements" % args.elements)
+    print("recursive: %.3fs (%.2f us/element)" % (recursive, recursive / args.elements * 1e6))
+    print("iterative: %.3fs (%.2f us/element)" % (iterative, iterative / args.elements * 1e6))
+    print("speedup: %.2fx" % (recursive / iterative))
+
+
+def _peak_memory(func):
+    """ Peak bytes allocated by Python while running func """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def pipeline_stages(document):
+    """ [(stage name, setup, function)] for each stage of converting document, in order.
+        Each function only redoes its own stage, on the result of the previous one;
+        setup (if not None) prepares its input and is not timed.
+    """
+    import main
+
+    state = {}
+
+    def parse():
+        parser = main.LineNumberingParser(encoding="utf-8")
+        parser.feed(document)
+        state['root'] = parser.close()
+
+    def namespaces():
+        state['qnames'], state['namespaces'] = main._namespaces(state['root'])
+
+    def serialize():
+        smap = state['smap'] = main.SourceMapGenerator()
+        out = main.MappedWriter(io.StringIO().write, smap, smap.add_source("input.html"))
+        main._serialize_xml(out, state['root'], state['qnames'], state['namespaces'],
+                            short_empty_elements=True)
+        out.flush()
+
+    def mapping_objects():
+        state['mappings'] = list(state['smap'])
+
+    def add_mapping():
+        smap = main.SourceMapGenerator()
+        for mapping in state['mappings']:
+            smap.addMapping(mapping)
+
+    def serialize_mappings():
+        state['smap'].serializeMappings()
+
+    def to_json():
+        state['smap'].to_json()
+
+    return [('parse', None, parse), ('_namespaces', None, namespaces),
+            ('_serialize_xml', None, serialize), ('addMapping', mapping_objects, add_mapping),
+            ('serializeMappings', None, serialize_mappings), ('to_json', None, to_json)]
+
+
+def bench_pipeline(args):
+    import main
+
+    document = synthetic_document(args.elements, depth=args.depth, attributes=args.attributes,
+                                  text_ratio=args.text_ratio)
+    results = {
+        'document': {'elements': args.elements, 'depth': args.depth,
+                     'attributes': args.attributes, 'text_ratio': args.text_ratio,
+                     'bytes': len(document.encode('utf-8'))},
+        'python': platform.python_version(),
+        'numpy': main.numpy is not None,
+        'repeat': args.repeat,
+        'stages': {},
+    }
+    stages = pipeline_stages(document)
+    # timings first, without tracemalloc slowing everything down
+    for name, setup, func in stages:
+        if setup is not None:
+            setup()
+        results['stages'][name] = {'seconds': _time(func, args.repeat)}
+    for name, setup, func in stages:
+        results['stages'][name]['peak_bytes'] = _peak_memory(func)
+
+    print("document: %(elements)d elements, depth %(depth)d, %(attributes)d attributes, "
+          "text ratio %(text_ratio).2f, %(bytes)d bytes" % results['document'])
+    for name, _, _ in stages:
+        stage = results['stages'][name]
+        print("%-18s %8.4fs %10.1f MB peak" % (name, stage['seconds'], stage['peak_bytes'] / 1e6))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+def bench_compare(args):
+    """ Exit 1 when a stage of args.results is more than args.threshold slower
+        (or uses that much more memory) than in args.baseline
+    """
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+    if baseline['document'] != results['document']:
+        print("warning: the documents differ: %r vs %r" % (baseline['document'], results['document']))
+    regressions = 0
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        for key in 'seconds', 'peak_bytes':
+            before = baseline['stages'][name][key]
+            ratio = stage[key] / before if before else 1.0
+            regressed = ratio > 1 + args.threshold
+            regressions += regressed
+            print("%-18s %-10s %6.2fx%s" % (name, key, ratio, "  REGRESSION" if regressed else ""))
+    return 1 if regressions else 0
+
+
+def bench_mapformat(args):
+    """ Save and load the sourcemap of a synthetic document as JSON and in the binary format """
+    import main
+
+    parser = main.LineNumberingParser(encoding="utf-8")
+    parser.feed(synthetic_document(args.elements))
+    root = parser.close()
+    qnames, namespaces = main._namespaces(root)
+    smap = main.SourceMapGenerator()
+    out = main.MappedWriter(io.StringIO().write, smap, smap.add_source("input.html"))
+    main._serialize_xml(out, root, qnames, namespaces, short_empty_elements=True)
+    out.flush()
+    json_map = smap.to_json()
+    binary_map = smap.to_binary()
+
+    timings = [
+        ("save", _time(smap.to_json, args.repeat), _time(smap.to_binary, args.repeat)),
+        ("load", _time(lambda: main.SourceMapConsumer(json.loads(json_map)), args.repeat),
+         _time(lambda: main.SourceMapConsumer.from_binary(binary_map), args.repeat)),
+        ("load generator", _time(lambda: main.SourceMapGenerator.from_binary(main.json_map_to_binary(json_map)),
+                                 args.repeat),
+         _time(lambda: main.SourceMapGenerator.from_binary(binary_map), args.repeat)),
+    ]
+
+    print("document: %d elements, %d mappings" % (args.elements, len(smap)))
+    print("size: JSON %d bytes, binary %d bytes" % (len(json_map), len(binary_map)))
+    print("%-15s %10s %10s %8s" % ("", "JSON", "binary", "speedup"))
+    for name, json_seconds, binary_seconds in timings:
+        print("%-15s %9.4fs %9.4fs %7.1fx" % (name, json_seconds, binary_seconds,
+                                             json_seconds / binary_seconds))
+
+
+def bench_splice(args):
+    """ Write a synthetic document back with splice_tree, with no and with a few dirty
+        elements, compared to serializing all of it and to copying its text
+    """
+    import main
+
+    source = synthetic_document(args.elements).encode('utf-8')
+    parser = main.LineNumberingParser(encoding="utf-8")
+    parser.feed(source)
+    root = parser.close()
+    elements = list(root.iter())
+    dirty = set(random.Random(0).sample(elements, min(args.dirty, len(elements))))
+
+    def copy():
+        io.StringIO().write(source.decode('utf-8'))
+
+    def serialize():
+        smap = main.SourceMapGenerator()
+        main.writeXML("input.html", smap, root, io.StringIO())
+
+    def splice(dirty, granularity):
+        return lambda: main.splice_tree("input.html", root, source, io.StringIO(), dirty,
+                                        granularity=granularity)
+
+    copy_seconds = _time(copy, args.repeat)
+    print("document: %d elements, %d bytes" % (len(elements), len(source)))
+    print("%-26s %9s %9s" % ("", "seconds", "x copy"))
+    runs = [("copy", copy), ("writeXML", serialize)]
+    for granularity in main.SPLICE_GRANULARITIES:
+        runs.append(("splice %s, clean" % granularity, splice((), granularity)))
+        runs.append(("splice %s, %d dirty" % (granularity, len(dirty)), splice(dirty, granularity)))
+    for name, func in runs:
+        seconds = copy_seconds if func is copy else _time(func, args.repeat)
+        print("%-26s %8.4fs %8.1fx" % (name, seconds, seconds / copy_seconds))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark main.py")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    parse = commands.add_parser('parse', help="LineNumberingParser throughput, "
+                                              "compared to the old pure Python parser hook")
+    parse.add_argument('--elements', type=int, default=100000)
+    parse.add_argument('--repeat', type=int, default=3)
+    parse.set_defaults(func=bench_parse)
+
+    serialize = commands.add_parser('serialize', help="_serialize_xml cost per element, "
+                                                      "compared to the old recursive serializer")
+    serialize.add_argument('--elements', type=int, default=100000)
+    serialize.add_argument('--repeat', type=int, default=3)
+    serialize.set_defaults(func=bench_serialize)
+
+    pipeline = commands.add_parser('pipeline', help="time and peak memory of each stage of "
+                                                    "a conversion, on a synthetic document")
+    pipeline.add_argument('--elements', type=int, default=100000)
+    pipeline.add_argument('--depth', type=int, default=8, help="maximum nesting")
+    pipeline.add_argument('--attributes', type=int, default=3,
+                          help="maximum attributes per element")
+    pipeline.add_argument('--text-ratio', type=float, default=0.6,
+                          help="fraction of elements with text")
+    pipeline.add_argument('--repeat', type=int, default=5)
+    pipeline.add_argument('--output', metavar='results.json',
+                          help="write the results as JSON (for compare)")
+    pipeline.set_defaults(func=bench_pipeline)
+
+    compare = commands.add_parser('compare', help="compare two pipeline --output files")
+    compare.add_argument('baseline')
+    compare.add_argument('results')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help="allowed slowdown/growth, as a fraction (default 0.1); "
+                              "timings of small documents are noisy, use a big one")
+    compare.set_defaults(func=bench_compare)
+
+    mapformat = commands.add_parser('mapformat', help="sourcemap save/load time as JSON "
+                                                      "(json.loads + VLQ) and in the binary format")
+    mapformat.add_argument('--elements', type=int, default=100000)
+    mapformat.add_argument('--repeat', type=int, default=3)
+    mapformat.set_defaults(func=bench_mapformat)
+
+    splice = commands.add_parser('splice', help="splice_tree compared to writeXML and to "
+                                                "copying the document")
+    splice.add_argument('--elements', type=int, default=100000)
+    splice.add_argument('--dirty', type=int, default=10,
+                        help="elements to mark dirty (default 10)")
+    splice.add_argument('--repeat', type=int, default=3)
+    splice.set_defaults(func=bench_splice)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'attributes', 0) < 0:
+        parser.error("--attributes cannot be negative")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
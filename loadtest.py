@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Load test for the conversion server (main.py serve).
+
+    python loadtest.py [--requests N] [--concurrency C] [--elements E]
+
+Starts a server on a temporary Unix socket (or uses --socket PATH) and reports
+p50/p99 latency for uncached and cached conversions and lookups.
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import synthetic_document
+
+
+async def _request(path, requests, latencies):
+    """ Send requests over one connection, appending (kind, seconds) to latencies """
+    reader, writer = await asyncio.open_unix_connection(path, limit=1 << 30)
+    try:
+        for kind, request in requests:
+            start = time.perf_counter()
+            writer.write(json.dumps(request).encode('utf-8') + b'\n')
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            if not response['ok']:
+                raise RuntimeError(response['error'])
+            latencies.append((kind, time.perf_counter() - start))
+    finally:
+        writer.close()
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+async def run(args, path):
+    documents = [synthetic_document(args.elements, seed=i) for i in range(args.requests)]
+    latencies = []
+
+    # Every document once: nothing is cached yet
+    uncached = [('uncached', {'op': 'convert', 'source': 'doc%d.html' % i, 'html': html})
+                for i, html in enumerate(documents)]
+    # The same documents again: answered from the cache
+    cached = [('cached', request) for _, request in uncached]
+    lookups = [('lookup', {'op': 'lookup', 'key': None, 'positions': [[1, 0], [2, 5], [3, 10]]})
+               for _ in documents]
+
+    for phase in (uncached, cached):
+        chunks = [phase[i::args.concurrency] for i in range(args.concurrency)]
+        await asyncio.gather(*(_request(path, chunk, latencies) for chunk in chunks if chunk))
+
+    # Look up positions in the results we just converted
+    reader, writer = await asyncio.open_unix_connection(path, limit=1 << 30)
+    for (_, convert), (_, lookup) in zip(cached, lookups):
+        writer.write(json.dumps(convert).encode('utf-8') + b'\n')
+        await writer.drain()
+        lookup['key'] = json.loads(await reader.readline())['key']
+    writer.close()
+    # The first lookup of a map parses it, later ones use the cached consumer
+    for phase in (lookups, [('cached lookup', request) for _, request in lookups]):
+        chunks = [phase[i::args.concurrency] for i in range(args.concurrency)]
+        await asyncio.gather(*(_request(path, chunk, latencies) for chunk in chunks if chunk))
+
+    print("%d requests per kind, concurrency %d, %d elements per document"
+          % (args.requests, args.concurrency, args.elements))
+    for kind in ('uncached', 'cached', 'lookup', 'cached lookup'):
+        values = [seconds for k, seconds in latencies if k == kind]
+        print("%-13s p50 %8.2f ms   p99 %8.2f ms" % (
+            kind, _percentile(values, 50) * 1000, _percentile(values, 99) * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test main.py serve")
+    parser.add_argument('--socket', metavar='PATH',
+                        help="use an already running server instead of starting one")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--elements', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    server = None
+    path = args.socket
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), 'serve.sock')
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__) or '.', 'main.py'),
+                                   'serve', '--socket', path])
+        while not os.path.exists(path):
+            if server.poll() is not None:
+                raise RuntimeError("server exited")
+            time.sleep(0.05)
+    try:
+        asyncio.run(run(args, path))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,55 +3,405 @@
 from __future__ import print_function
 
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import glob
+import hashlib
+import io
 import logging
+import mmap
+import operator
+import os
 import sys
+import threading
+import time
+import traceback
+import tracemalloc
 import contextlib
 import base64
 import json
+import bisect
+import re
+import shutil
+import struct
+import tempfile
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-# Force python XML parser not faster C accelerators
-# because we can't hook the C implementation
-sys.modules['_elementtree'] = None
 import xml.etree as etree
 import xml.etree.ElementTree as ET
-from xml.etree.ElementTree import QName, Comment, ProcessingInstruction
+from xml.parsers import expat
+from xml.etree.ElementTree import QName, Comment, ProcessingInstruction, PI
+from xml.etree.ElementTree import _namespace_map, _raise_serialization_error
+
+
+class MappedWriter(object):
+    """ Write serialized fragments and add a sourcemap mapping for each one.
+        Keeps track of the line/column of the output (lines are 1-based,
+        columns are 0-based like expat's and the sourcemap spec's).
+
+        Fragments and mappings are collected and handed to write() and smap in
+        chunks, so each fragment costs a few appends instead of a write() call and
+        an add_raw call. Call flush() before using smap or the output.
+    """
+    __slots__ = ('_write', '_sink', '_parts', '_smap', '_columns',
+                 '_add_generated_line', '_add_generated_column', '_add_original_line',
+                 '_add_original_column', '_add_name', 'source_idx', 'line', 'column')
+    # Flush once this many fragments are collected (checked at newlines)
+    CHUNK_PARTS = 4096
+
+    def __init__(self, write, smap, source_idx):
+        self._sink = write
+        self._parts = []
+        self._write = self._parts.append
+        self._smap = smap
+        # generated lines, generated columns, original lines, original columns, names
+        self._columns = columns = (array('i'), array('i'), array('i'), array('i'), array('i'))
+        (self._add_generated_line, self._add_generated_column, self._add_original_line,
+         self._add_original_column, self._add_name) = [column.append for column in columns]
+        self.source_idx = source_idx
+        self.line = 1
+        self.column = 0
+
+    def write(self, text, original_line, original_column, name_idx=-1):
+        """ Write text, which came from original_line/original_column of the source """
+        self._add_generated_line(self.line)
+        self._add_generated_column(self.column)
+        self._add_original_line(original_line)
+        self._add_original_column(original_column)
+        self._add_name(name_idx)
+        self._write(text)
+        if "\n" in text:
+            self.line += text.count("\n")
+            self.column = len(text) - text.rfind("\n") - 1
+            if len(self._parts) >= self.CHUNK_PARTS:
+                self.flush()
+        else:
+            self.column += len(text)
+
+    def write_unmapped(self, text):
+        """ Write text that did not come from the source (no mapping is added) """
+        self._write(text)
+        if "\n" in text:
+            self.line += text.count("\n")
+            self.column = len(text) - text.rfind("\n") - 1
+        else:
+            self.column += len(text)
+
+    def flush(self):
+        """ Hand the collected mappings to smap and the collected text to write() """
+        generated_lines, generated_columns, original_lines, original_columns, names = self._columns
+        if generated_lines:
+            self._smap.extend_raw(generated_lines, generated_columns, self.source_idx,
+                                  original_lines, original_columns, names)
+            for column in self._columns:
+                del column[:]
+        if self._parts:
+            self._sink("".join(self._parts))
+            del self._parts[:]
+
+
+class _SimplifyingWriter(MappedWriter):
+    """ MappedWriter that leaves out the mappings SourceMapGenerator.simplify would
+        drop, as it writes them, and with whitespace=True also the mappings of
+        whitespace-only text (lookups there then give the mapping before it).
+    """
+    __slots__ = ('whitespace', '_previous')
 
+    def __init__(self, write, smap, source_idx, whitespace=False):
+        super(_SimplifyingWriter, self).__init__(write, smap, source_idx)
+        self.whitespace = whitespace
+        # (generated line, original line, original column, name) of the last mapping
+        self._previous = None
 
-def adjust_pos(line_num, column_num, str):
-    """ Keeps track of the line/column when serializing
-        This is used for the output sourcemap file
+    def write(self, text, original_line, original_column, name_idx=-1):
+        current = (self.line, original_line, original_column, name_idx)
+        if current == self._previous or (self.whitespace and text.isspace()):
+            MappedWriter.write_unmapped(self, text)
+            return
+        self._previous = current
+        MappedWriter.write(self, text, original_line, original_column, name_idx)
+
+
+# How much of the mappings to drop (see --simplify-map): "repeats" drops the mappings
+# that do not change lookups, "whitespace" also those of whitespace-only text.
+MAP_SIMPLIFICATIONS = ('none', 'repeats', 'whitespace')
+
+
+def _mapped_writer(write, smap, source_idx, simplify='none'):
+    if simplify not in MAP_SIMPLIFICATIONS:
+        raise ValueError('Unknown map simplification: %r' % (simplify,))
+    if simplify == 'none':
+        return MappedWriter(write, smap, source_idx)
+    return _SimplifyingWriter(write, smap, source_idx, whitespace=simplify == 'whitespace')
+
+
+class PositionedElement(ET.Element):
+    """ Element that also holds where it was in the source file (see LineNumberingParser) """
+    __slots__ = ('_start_line_number', '_start_column_number', '_start_byte_index',
+                 '_end_line_number', '_end_column_number', '_end_byte_index',
+                 '_positions', '_namespace_uris')
+
+
+class _Positions(object):
+    """ Where the parts of an element were in the source, for mapping granularities
+        finer than "element" (see LineNumberingParser). Each is an array('i') or None:
+          attributes -- name line, name column, value line, value column for each
+                        attribute, in document order (xmlns declarations left out)
+          text, tail -- line, column where the text run starts, then (with "token")
+                        line, column of each whitespace-separated token in it
     """
-    lines = str.splitlines()
-    line_num += len(lines) - 1
-    column_num = len(lines[-1]) + 1 # Columns are 1-based???
-    return (line_num, column_num)
+    __slots__ = ('attributes', 'text', 'tail')
 
+    def __init__(self):
+        self.attributes = self.text = self.tail = None
+
+
+# Mapping granularities, coarsest first; each one adds mappings to the previous
+MAP_GRANULARITIES = ('element', 'attribute', 'text', 'token')
+_GRANULARITY_ATTRIBUTE, _GRANULARITY_TEXT, _GRANULARITY_TOKEN = 1, 2, 3
+
+_START_TAG_RE = re.compile(rb'<[^\s/>]+((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*(/?)>')
+_ATTRIBUTE_TEXT_RE = re.compile(r'\s([^\s=/>]+)\s*=\s*("[^"]*"|\'[^\']*\')')
+# Tokens of a text run in the source and in the serialized text; only XML
+# whitespace separates them so both sides split the same way
+_SOURCE_TOKEN_RE = re.compile(rb'[^ \t\n\r]+')
+_TOKEN_RE = re.compile(r'[^ \t\n\r]+')
 
-class LineNumberingParser(ET.XMLParser):
+
+class LineNumberingParser(object):
     """ Record the line and column numbers for elements (to create a sourcemap later)
-    TODO: also record line/column information for attribute names, values, and text nodes
-          because they can come from different places (different XML files, CSS recipe files)
-    """
-    def _start_list(self, *args, **kwargs):
-        # Here we assume the default XML parser which is expat
-        # and copy its element position attributes into output Elements
-        element = super(self.__class__, self)._start_list(*args, **kwargs)
-        # print("OPEN", self.parser.CurrentLineNumber, self.parser.CurrentColumnNumber)
-        element._start_line_number = self.parser.CurrentLineNumber
-        element._start_column_number = self.parser.CurrentColumnNumber
-        element._start_byte_index = self.parser.CurrentByteIndex
+
+    This drives expat directly instead of hooking the pure Python ET.XMLParser,
+    which is what the C accelerator hides from us. The tree itself is still built by
+    the (C) TreeBuilder; only the start/end callbacks run in Python so they can copy
+    the expat position into PositionedElements.
+    Use it like an XMLParser: ET.parse(source, LineNumberingParser()).
+
+    With a granularity other than "element" (see MAP_GRANULARITIES) the parser also
+    keeps the not yet parsed part of the (UTF-8) input and scans each tag for the
+    positions of attribute names and values ("attribute"), of text runs ("text") and
+    of the tokens in them ("token"), stored in element._positions. expat does not
+    report these, and they can come from elsewhere than the element itself.
+    """
+    def __init__(self, target=None, encoding=None, granularity='element'):
+        if granularity not in MAP_GRANULARITIES:
+            raise ValueError('Unknown mapping granularity: %r' % (granularity,))
+        self.granularity = granularity
+        self._detail = MAP_GRANULARITIES.index(granularity)
+        if self._detail:
+            # the input from the byte index of the last tag on
+            self._buffer = bytearray()
+            self._buffer_start = 0
+            self._keep = 0
+            # (positions array, byte index) of the text run that started last
+            self._pending = None
+        parser = expat.ParserCreate(encoding, "}")
+        if target is None:
+            target = ET.TreeBuilder(element_factory=PositionedElement)
+        # underscored names are provided for compatibility with ET.XMLParser
+        self.parser = self._parser = parser
+        self.target = self._target = target
+        self._names = {} # name memo cache
+        # namespace uris in the order _namespaces would meet them (the keys)
+        self._namespace_uris = {}
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        if hasattr(target, 'data'):
+            parser.CharacterDataHandler = target.data
+        if hasattr(target, 'comment'):
+            parser.CommentHandler = target.comment
+        if hasattr(target, 'pi'):
+            parser.ProcessingInstructionHandler = target.pi
+        parser.buffer_text = 1
+        self.version = "Expat %d.%d.%d" % expat.version_info
+
+    def _fixname(self, key):
+        # expand qname
+        try:
+            name = self._names[key]
+        except KeyError:
+            name = key
+            if "}" in name:
+                name = "{" + name
+                self._namespace_uris.setdefault(key.rsplit("}", 1)[0])
+            self._names[key] = name
+        return name
+
+    def _start(self, tag, attrib):
+        # the tag before the attributes, like _namespaces meets them
+        try:
+            tag = self._names[tag]
+        except KeyError:
+            tag = self._fixname(tag)
+        # expat already hands us the attributes as a dict (in document order);
+        # only namespaced ones need their names expanded
+        if attrib and "}" in "".join(attrib):
+            fixname = self._fixname
+            attrib = dict((fixname(key), value) for key, value in attrib.items())
+        element = self.target.start(tag, attrib)
+        parser = self.parser
+        # print("OPEN", parser.CurrentLineNumber, parser.CurrentColumnNumber)
+        element._start_line_number = parser.CurrentLineNumber
+        element._start_column_number = parser.CurrentColumnNumber
+        element._start_byte_index = parser.CurrentByteIndex
+        if self._detail:
+            self._start_positions(element)
         return element
 
-    def _end(self, *args, **kwargs):
-        element = super(self.__class__, self)._end(*args, **kwargs)
-        # print("CLOSE", self.parser.CurrentLineNumber, self.parser.CurrentColumnNumber)
-        element._end_line_number = self.parser.CurrentLineNumber
-        element._end_column_number = self.parser.CurrentColumnNumber
-        element._end_byte_index = self.parser.CurrentByteIndex
+    def _end(self, tag):
+        try:
+            tag = self._names[tag]
+        except KeyError:
+            tag = self._fixname(tag)
+        element = self.target.end(tag)
+        parser = self.parser
+        # print("CLOSE", parser.CurrentLineNumber, parser.CurrentColumnNumber)
+        element._end_line_number = parser.CurrentLineNumber
+        element._end_column_number = parser.CurrentColumnNumber
+        element._end_byte_index = parser.CurrentByteIndex
+        if self._detail >= _GRANULARITY_TEXT:
+            self._end_positions(element)
         return element
 
+    def _advance(self, offset, line, column, target):
+        """ line/column of buffer offset target, given that offset is at line/column """
+        buffer = self._buffer
+        newline = buffer.rfind(b"\n", offset, target)
+        if newline < 0:
+            return line, column + len(buffer[offset:target].decode("utf-8"))
+        return (line + buffer.count(b"\n", offset, target),
+                len(buffer[newline + 1:target].decode("utf-8")))
+
+    def _end_text(self, index):
+        """ The text run that started last ends before byte index: find its tokens """
+        self._keep = index
+        pending = self._pending
+        self._pending = None
+        if pending is None or self._detail < _GRANULARITY_TOKEN:
+            return
+        positions, start = pending
+        offset = start - self._buffer_start
+        end = self._buffer.find(b"<", offset, index - self._buffer_start)
+        if end < 0:
+            end = index - self._buffer_start
+        line = positions[0]
+        column = positions[1]
+        advance = self._advance
+        for token in _SOURCE_TOKEN_RE.finditer(self._buffer, offset, end):
+            line, column = advance(offset, line, column, token.start())
+            offset = token.start()
+            positions.append(line)
+            positions.append(column)
+
+    def _start_positions(self, element):
+        index = element._start_byte_index
+        self._end_text(index)
+        line = element._start_line_number
+        column = element._start_column_number
+        positions = element._positions = _Positions()
+        tag = _START_TAG_RE.match(self._buffer, index - self._buffer_start)
+        if tag is None:
+            return
+        # work on the decoded tag so offsets are in characters, like expat's columns
+        text = tag.group(0).decode("utf-8")
+        multiline = "\n" in text
+        attributes = positions.attributes = array('i')
+        for attribute in _ATTRIBUTE_TEXT_RE.finditer(text):
+            name = attribute.group(1)
+            if name[:5] == "xmlns" and (len(name) == 5 or name[5] == ":"):
+                # expat turns these into namespaces, they are not in attrib
+                continue
+            if not multiline:
+                attributes.extend((line, column + attribute.start(1),
+                                   line, column + attribute.start(2) + 1))
+                continue
+            for start in attribute.start(1), attribute.start(2) + 1:
+                newline = text.rfind("\n", 0, start)
+                if newline < 0:
+                    attributes.extend((line, column + start))
+                else:
+                    attributes.extend((line + text.count("\n", 0, start), start - newline - 1))
+        if self._detail >= _GRANULARITY_TEXT and not tag.group(2):
+            end = len(text)
+            if multiline:
+                positions.text = array('i', (line + text.count("\n"), end - text.rfind("\n") - 1))
+            else:
+                positions.text = array('i', (line, column + end))
+            self._pending = (positions.text, self._buffer_start + tag.end())
+
+    def _end_positions(self, element):
+        index = element._end_byte_index
+        self._end_text(index)
+        positions = element._positions
+        if positions.text is None:
+            # an empty-element tag <a/>: expat reports its end after the tag
+            positions.tail = array('i', (element._end_line_number, element._end_column_number))
+            self._pending = (positions.tail, index)
+            return
+        offset = index - self._buffer_start
+        end = self._buffer.find(b">", offset)
+        if end < 0:
+            return
+        positions.tail = array('i', self._advance(offset, element._end_line_number,
+                                                  element._end_column_number, end + 1))
+        self._pending = (positions.tail, index + end + 1 - offset)
+
+    def _raiseerror(self, value):
+        err = ET.ParseError(value)
+        err.code = value.code
+        err.position = value.lineno, value.offset
+        raise err
+
+    def feed(self, data):
+        """Feed encoded data to parser."""
+        if self._detail:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            # everything before the last tag has been scanned
+            keep = self._keep
+            if keep > self._buffer_start:
+                del self._buffer[:keep - self._buffer_start]
+                self._buffer_start = keep
+            self._buffer += data
+        try:
+            self.parser.Parse(data, False)
+        except expat.error as v:
+            self._raiseerror(v)
+
+    def close(self):
+        """Finish feeding data to parser and return element structure."""
+        try:
+            self.parser.Parse(b"", True) # end of data
+        except expat.error as v:
+            self._raiseerror(v)
+        if self._detail:
+            self._end_text(self._buffer_start + len(self._buffer))
+            self._buffer = None
+        try:
+            close_handler = self.target.close
+        except AttributeError:
+            pass
+        else:
+            root = close_handler()
+            if isinstance(root, PositionedElement):
+                # lets writeXML skip the _namespaces pass (see _cached_namespaces)
+                root._namespace_uris = tuple(self._namespace_uris)
+            return root
+        finally:
+            # get rid of circular references
+            del self.parser, self._parser
+            del self.target, self._target
+
+
+class Mapping(object):
+    __slots__ = ('generatedLine', 'generatedColumn', 'originalLine', 'originalColumn', 'source', 'name')
 
-class Mapping:
     def __init__(self, generatedLine=None, generatedColumn=None, source=None, originalLine=None, originalColumn=None, name=None):
         """Mapping Object (contains a single mapping)"""
         self.generatedLine = generatedLine
@@ -113,266 +463,1933 @@ def fromVLQSigned(aValue):
   return -shifted if isNegative else shifted
 
 
-# From http://stackoverflow.com/a/30238073
-def rshift(val, n):
-    s = val & 0x80000000
-    for i in range(0,n):
-        val >>= 1
-        val |= s
-    return val
-
 intToCharMap = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
 
+def _encode_vlq(aValue):
+  """
+   Base 64 VLQ encode a single value without the lookup table.
+  """
+  vlq = toVLQSigned(aValue)
+  digit = vlq & VLQ_BASE_MASK
+  vlq >>= VLQ_BASE_SHIFT
+  if not vlq:
+    return intToCharMap[digit]
+  encoded = []
+  while vlq:
+    # There are still more digits in this value, so we must make sure the
+    # continuation bit is marked.
+    encoded.append(intToCharMap[digit | VLQ_CONTINUATION_BIT])
+    digit = vlq & VLQ_BASE_MASK
+    vlq >>= VLQ_BASE_SHIFT
+  encoded.append(intToCharMap[digit])
+  return ''.join(encoded)
+
+# Most deltas in a sourcemap are small (the distance to the previous column or line)
+# so precompute their encodings. Values in [-VLQ_TABLE_OFFSET, VLQ_TABLE_OFFSET)
+# are looked up at index aValue + VLQ_TABLE_OFFSET.
+VLQ_TABLE_OFFSET = 4096
+VLQ_TABLE = [_encode_vlq(v) for v in range(-VLQ_TABLE_OFFSET, VLQ_TABLE_OFFSET)]
+
 def base64VLQ_encode(aValue):
   """
    Returns the base 64 VLQ encoded value.
   """
-  encoded = ""
-  digit = 0
+  if -VLQ_TABLE_OFFSET <= aValue < VLQ_TABLE_OFFSET:
+    return VLQ_TABLE[aValue + VLQ_TABLE_OFFSET]
+  return _encode_vlq(aValue)
 
-  vlq = toVLQSigned(aValue)
 
-  condition = True
-  while condition:
-    digit = vlq & VLQ_BASE_MASK
-    # vlq >>>= VLQ_BASE_SHIFT
-    vlq = rshift(vlq, VLQ_BASE_SHIFT)
-    if (vlq > 0):
-      # There are still more digits in this value, so we must make sure the
-      # continuation bit is marked.
-      # digit |= VLQ_CONTINUATION_BIT
-      digit = digit | VLQ_CONTINUATION_BIT
-
-    # encoded += base64.encode(digit)
-    encoded += intToCharMap[digit]
-    condition = (vlq > 0)
+charToIntMap = dict((c, i) for i, c in enumerate(intToCharMap))
 
-  return encoded
+def base64VLQ_decode(aStr, aIndex=0):
+  """
+   Decodes the next base 64 VLQ value from the given string starting at aIndex.
+   Returns the value and the index just past it.
+  """
+  strLen = len(aStr)
+  result = 0
+  shift = 0
 
+  while True:
+    if (aIndex >= strLen):
+      raise ValueError("Expected more digits in base 64 VLQ value.")
 
-# def base64VLQ_decode(aStr, aIndex, aOutParam):
-# """
-#  Decodes the next base 64 VLQ value from the given string and returns the
-#  value and the rest of the string via the out parameter.
-# """
-#   strLen = aStr.length
-#   result = 0
-#   shift = 0
-#   continuation, digit
-#
-#   do:
-#     if (aIndex >= strLen):
-#       throw new Error("Expected more digits in base 64 VLQ value.")
-#
-#     digit = base64.decode(aStr.charCodeAt(aIndex+=1))
-#     if (digit == -1):
-#       throw new Error("Invalid base64 digit: " + aStr.charAt(aIndex - 1))
-#
-#     continuation = !!(digit & VLQ_CONTINUATION_BIT)
-#     digit &= VLQ_BASE_MASK
-#     result = result + (digit << shift)
-#     shift += VLQ_BASE_SHIFT
-#    while (continuation)
-#
-#   aOutParam.value = fromVLQSigned(result)
-#   aOutParam.rest = aIndex
+    digit = charToIntMap.get(aStr[aIndex], -1)
+    if (digit == -1):
+      raise ValueError("Invalid base64 digit: " + aStr[aIndex])
+    aIndex += 1
+
+    result += (digit & VLQ_BASE_MASK) << shift
+    if not (digit & VLQ_CONTINUATION_BIT):
+      break
+    shift += VLQ_BASE_SHIFT
+
+  return fromVLQSigned(result), aIndex
+
+
+def _decode_segment(segment):
+  """
+   Decode every VLQ value in one comma-separated segment of the mappings string.
+  """
+  values = []
+  index = 0
+  while index < len(segment):
+    value, index = base64VLQ_decode(segment, index)
+    values.append(value)
+  if len(values) not in (1, 4, 5):
+    raise ValueError("Invalid sourcemap segment: " + segment)
+  return values
+
+
+def _decode_mappings(mappings):
+  """
+   Parse a v3 "mappings" string into parallel array('i') columns
+   (generated line, generated column, source index, original line, original column, name index)
+   with the same conventions as SourceMapGenerator: lines are 1-based and
+   -1 is used for a missing source or name.
+   Mappings are returned sorted by generated line and then generated column.
+  """
+  generated_lines = array('i')
+  generated_columns = array('i')
+  original_sources = array('i')
+  original_lines = array('i')
+  original_columns = array('i')
+  original_names = array('i')
+
+  previousSource = 0
+  previousOriginalLine = 0
+  previousOriginalColumn = 0
+  previousName = 0
+
+  # The same segments (e.g. "AAAA") show up over and over, so only decode each one once
+  decoded = {}
+
+  for line_idx, line in enumerate(mappings.split(';')):
+    if not line:
+      continue
+    generatedLine = line_idx + 1
+    generatedColumn = 0
+    line_start = len(generated_lines)
+    in_order = True
+    for segment in line.split(','):
+      if not segment:
+        continue
+      values = decoded.get(segment)
+      if values is None:
+        values = decoded[segment] = _decode_segment(segment)
+
+      if values[0] < 0:
+        in_order = False
+      generatedColumn += values[0]
+      generated_lines.append(generatedLine)
+      generated_columns.append(generatedColumn)
+      if len(values) == 1:
+        original_sources.append(-1)
+        original_lines.append(0)
+        original_columns.append(0)
+        original_names.append(-1)
+        continue
+
+      previousSource += values[1]
+      previousOriginalLine += values[2]
+      previousOriginalColumn += values[3]
+      original_sources.append(previousSource)
+      # lines are stored 0-based in SourceMap spec version 3
+      original_lines.append(previousOriginalLine + 1)
+      original_columns.append(previousOriginalColumn)
+      if len(values) == 5:
+        previousName += values[4]
+        original_names.append(previousName)
+      else:
+        original_names.append(-1)
+
+    if not in_order:
+      # Rare, but the spec does not require segments to be sorted within a line
+      columns = (generated_columns, original_sources, original_lines, original_columns, original_names)
+      order = sorted(range(line_start, len(generated_lines)), key=generated_columns.__getitem__)
+      for column in columns:
+        column[line_start:] = array('i', [column[i] for i in order])
+
+  return (generated_lines, generated_columns, original_sources,
+          original_lines, original_columns, original_names)
+
+
+def _line_starts(generated_lines):
+    """ array('i') where the mappings of generated line L (generated_lines is sorted)
+        are at indexes [starts[L], starts[L + 1])
+    """
+    last_line = generated_lines[-1] if len(generated_lines) else 0
+    line_starts = array('i', [0]) * (last_line + 2)
+    for line in generated_lines:
+        line_starts[line + 1] += 1
+    for line in range(1, last_line + 2):
+        line_starts[line] += line_starts[line - 1]
+    return line_starts
+
+
+# Generated lines per section of SourceMapGenerator.to_index_json
+INDEX_MAP_SECTION_LINES = 10000
 
 
 # From https://github.com/mozilla/source-map/blob/master/lib/source-map-generator.js#L286
 class SourceMapGenerator:
+    """ Accumulates mappings and serializes them to a v3 sourcemap.
+
+        Mappings are stored column-wise in parallel arrays (one entry per mapping)
+        instead of one Mapping object each. Sources and names are interned and
+        the arrays hold their indexes (-1 when a mapping has no source/name).
+        Iterating the generator yields Mapping objects built on the fly.
+    """
     def __init__(self):
-        self._mappings = []
         self._sources = []
         self._names = []
+        # source/name -> index into self._sources/self._names
+        self._source_indexes = {}
+        self._name_indexes = {}
+        # source -> its text, for sourcesContent (see set_source_content)
+        self._sources_content = {}
+        self._generated_lines = array('i')
+        self._generated_columns = array('i')
+        self._original_sources = array('i')
+        self._original_lines = array('i')
+        self._original_columns = array('i')
+        self._original_names = array('i')
+        # _serialize_xml adds mappings in generated order so the common case
+        # is a plain append. Only sort (once) when something arrived out of order.
+        self._sorted = True
+        self._last_generated_line = 0
+        # set while writing with start_stream()/flush_mappings()/end_stream()
+        self._stream = None
+        self._stream_state = None
 
     def __str__(self):
         """Return string."""
-        return ',\n'.join(str(x) for x in self._mappings)
+        return ',\n'.join(str(x) for x in self)
+
+    def __len__(self):
+        return len(self._generated_lines)
+
+    def __iter__(self):
+        """ Yield a Mapping for each mapping, in generated order """
+        self._sort_mappings()
+        sources = self._sources
+        names = self._names
+        for gen_line, gen_col, src_idx, orig_line, orig_col, name_idx in zip(
+                self._generated_lines, self._generated_columns, self._original_sources,
+                self._original_lines, self._original_columns, self._original_names):
+            if src_idx < 0:
+                yield Mapping(generatedLine=gen_line, generatedColumn=gen_col)
+            else:
+                yield Mapping(generatedLine=gen_line, generatedColumn=gen_col,
+                              source=sources[src_idx], originalLine=orig_line, originalColumn=orig_col,
+                              name=names[name_idx] if name_idx >= 0 else None)
 
     def to_json(self):
         obj = dict()
         obj['version'] = 3
         obj['sources'] = self._sources
-        if len(self._names) > 0:
+        contents = self._sources_content_list()
+        if len(self._names) > 0 or contents is not None:
+            # always before sourcesContent, which readers stop at (see _json_map)
             obj['names'] = self._names
         obj['mappings'] = self.serializeMappings()
+        if contents is not None:
+            obj['sourcesContent'] = contents
         return json.dumps(obj)
 
+    def set_source_content(self, source, content):
+        """ Embed the text of source in the sourcemap (sourcesContent), or stop
+            embedding it when content is None. This is mozilla's setSourceContent.
+        """
+        if content is None:
+            self._sources_content.pop(source, None)
+        else:
+            self._sources_content[source] = content
+
+    def add_sources_content(self, contents, consumer=None):
+        """ Embed the text of each source that has none yet: from consumer (the
+            sourcemap of the input, see apply_source_map) when it embeds it,
+            otherwise read through contents, a SourceContentCache. Sources that
+            cannot be read get null.
+        """
+        for source in self._sources:
+            if source in self._sources_content:
+                continue
+            content = None
+            if consumer is not None:
+                content = consumer.source_content_for(source)
+            if content is None:
+                content = contents.read(source)
+            if content is not None:
+                self._sources_content[source] = content
+
+    def _sources_content_list(self):
+        """ The sourcesContent member (None when nothing is embedded) """
+        if not self._sources_content:
+            return None
+        get = self._sources_content.get
+        contents = [get(source) for source in self._sources]
+        if not any(content is not None for content in contents):
+            return None
+        return contents
+
+    def add_source(self, source):
+        """ Return the index of source in the sources list, adding it if necessary """
+        try:
+            return self._source_indexes[source]
+        except KeyError:
+            idx = self._source_indexes[source] = len(self._sources)
+            self._sources.append(source)
+            return idx
+
+    def add_name(self, name):
+        """ Return the index of name in the names list, adding it if necessary """
+        try:
+            return self._name_indexes[name]
+        except KeyError:
+            idx = self._name_indexes[name] = len(self._names)
+            self._names.append(name)
+            return idx
+
+    def add_raw(self, gen_line, gen_col, src_idx=-1, orig_line=0, orig_col=0, name_idx=-1):
+        """ Add a mapping using already-interned source/name indexes (see add_source/add_name).
+            This is the fast path used by the serializer; no Mapping object is created.
+        """
+        if gen_line < self._last_generated_line:
+            self._sorted = False
+        else:
+            self._last_generated_line = gen_line
+        self._generated_lines.append(gen_line)
+        self._generated_columns.append(gen_col)
+        self._original_sources.append(src_idx)
+        self._original_lines.append(orig_line)
+        self._original_columns.append(orig_col)
+        self._original_names.append(name_idx)
+
+    def extend_raw(self, gen_lines, gen_cols, src_idx, orig_lines, orig_cols, name_idxs=None):
+        """ Add a run of mappings (parallel sequences, in generated order) from
+            one source, like that many add_raw calls. Without name_idxs they have no names.
+        """
+        if not gen_lines:
+            return
+        if gen_lines[0] < self._last_generated_line:
+            self._sorted = False
+        else:
+            self._last_generated_line = gen_lines[-1]
+        count = len(gen_lines)
+        self._generated_lines.extend(gen_lines)
+        self._generated_columns.extend(gen_cols)
+        self._original_sources.extend(array('i', [src_idx]) * count)
+        self._original_lines.extend(orig_lines)
+        self._original_columns.extend(orig_cols)
+        if name_idxs is None:
+            self._original_names.extend(array('i', [-1]) * count)
+        else:
+            self._original_names.extend(name_idxs)
+
     def addMapping(self, mapping):
         if (mapping.generatedLine == 0):
           raise ValueError('Mapping contains invalid generatedLine. Line numbers are 1-based')
-        self._mappings.append(mapping)
-        self._mappings = sorted(self._mappings, key=lambda x: x.generatedLine)
+        if mapping.source is None:
+            self.add_raw(mapping.generatedLine, mapping.generatedColumn)
+            return
+        name_idx = -1
+        if mapping.name is not None:
+            name_idx = self.add_name(mapping.name)
+        self.add_raw(mapping.generatedLine, mapping.generatedColumn, self.add_source(mapping.source),
+                     mapping.originalLine, mapping.originalColumn, name_idx)
 
-        try:
-            self._sources.index(mapping.source)
-        except ValueError:
-            self._sources.append(mapping.source)
+    def apply_source_map(self, consumer, source_file=None):
+        """ Rewrite mappings that point into source_file so they point to where
+            consumer (the sourcemap of source_file) says that position came from.
+            This is mozilla's SourceMapGenerator.applySourceMap.
 
-        if mapping.name is not None:
-            try:
-                self._names.index(mapping.name)
-            except ValueError:
-                self._names.append(mapping.name)
+            Mappings with no match in consumer are kept as-is. source_file defaults to
+            consumer.file, or to the only source when there is just one.
+        """
+        if source_file is None:
+            source_file = consumer.file
+        if source_file is None:
+            if len(self._sources) != 1:
+                raise ValueError('apply_source_map needs source_file when there is more than one source')
+            source_file = self._sources[0]
+        if source_file not in self._source_indexes:
+            return
+        self._sort_mappings()
+        self._remap_mappings(consumer, self._source_indexes[source_file], len(self))
+
+        # Rebuild sources and names so they only list what the mappings still use
+        all_sources = self._sources
+        all_names = self._names
+        self._sources = []
+        self._names = []
+        self._source_indexes = {}
+        self._name_indexes = {}
+        add_source = self.add_source
+        add_name = self.add_name
+        original_sources = self._original_sources
+        original_names = self._original_names
+        for i, (src_idx, name_idx) in enumerate(zip(original_sources, original_names)):
+            if src_idx >= 0:
+                original_sources[i] = add_source(all_sources[src_idx])
+            if name_idx >= 0:
+                original_names[i] = add_name(all_names[name_idx])
+
+    def _remap_mappings(self, consumer, remapped_source, end):
+        """ Remap mappings [0, end) whose source is remapped_source through consumer.
+            Every source/name of consumer gets interned, used or not.
+        """
+        sources = [self.add_source(source) for source in consumer.sources]
+        names = [self.add_name(name) for name in consumer.names]
+
+        find = consumer._find_original
+        original_sources = self._original_sources
+        original_lines = self._original_lines
+        original_columns = self._original_columns
+        original_names = self._original_names
+        for i in range(end):
+            if original_sources[i] != remapped_source:
+                continue
+            found = find(original_lines[i], original_columns[i])
+            if found is None:
+                continue
+            src_idx, original_lines[i], original_columns[i], name_idx = found
+            original_sources[i] = sources[src_idx]
+            if name_idx >= 0:
+                original_names[i] = names[name_idx]
+
+    def simplify(self):
+        """ Drop the mappings that point to the same original position (and name) as
+            the previous mapping on their generated line, and return how many were
+            dropped. original_position_for gives the same results: the columns
+            they covered now fall to that previous mapping.
+        """
+        self._sort_mappings()
+        keep = []
+        previous = None
+        for i, current in enumerate(zip(self._generated_lines, self._original_sources,
+                                        self._original_lines, self._original_columns,
+                                        self._original_names)):
+            if current != previous:
+                keep.append(i)
+                previous = current
+        dropped = len(self) - len(keep)
+        if dropped:
+            for attr in ('_generated_lines', '_generated_columns', '_original_sources',
+                         '_original_lines', '_original_columns', '_original_names'):
+                column = getattr(self, attr)
+                setattr(self, attr, array('i', [column[i] for i in keep]))
+        return dropped
+
+    def _sort_mappings(self):
+        """ Order the mappings by generatedLine.
+            The sort is stable so mappings on the same line keep the order they were added in.
+        """
+        if not self._sorted:
+            order = sorted(range(len(self._generated_lines)), key=self._generated_lines.__getitem__)
+            for attr in ('_generated_lines', '_generated_columns', '_original_sources',
+                         '_original_lines', '_original_columns', '_original_names'):
+                column = getattr(self, attr)
+                setattr(self, attr, array('i', [column[i] for i in order]))
+            self._sorted = True
 
     def serializeMappings(self):
         """
          * Serialize the accumulated mappings in to the stream of base 64 VLQs
          * specified by the source map format.
         """
+        self._sort_mappings()
+        if numpy is not None and len(self) >= NUMPY_MIN_MAPPINGS:
+            return _serialize_mappings_numpy(
+                self._generated_lines, self._generated_columns, self._original_sources,
+                self._original_lines, self._original_columns, self._original_names)
+        return ';'.join(self._serialize_lines(len(self), _MappingsState()))
+
+    def sections(self, section_lines):
+        """ Split the mappings into SourceMapGenerators of section_lines generated
+            lines each, returned as [(first generated line, generator), ...].
+            Empty sections are left out. Every section lists all the sources and names,
+            but embeds the text of a source (sourcesContent) only in the first
+            section that maps to it (the first one for sources nothing maps to).
+        """
+        self._sort_mappings()
+        generated_lines = self._generated_lines
+        sections = []
+        # indexes of the sources whose text is not embedded in a section yet, and
+        # of those that no section maps to
+        unembedded = set(i for i, source in enumerate(self._sources)
+                         if source in self._sources_content)
+        unmapped = unembedded.difference(self._original_sources)
+        start = 0
+        while start < len(generated_lines):
+            first_line = generated_lines[start] - (generated_lines[start] - 1) % section_lines
+            end = bisect.bisect_left(generated_lines, first_line + section_lines, start)
+            section = SourceMapGenerator()
+            section._sources = self._sources
+            section._names = self._names
+            section._source_indexes = self._source_indexes
+            section._name_indexes = self._name_indexes
+            if unembedded:
+                embedded = unembedded.intersection(self._original_sources[start:end])
+                if not sections:
+                    embedded |= unmapped
+                unembedded -= embedded
+                section._sources_content = dict(
+                    (self._sources[i], self._sources_content[self._sources[i]]) for i in embedded)
+            section._generated_lines = array('i', [line - first_line + 1
+                                                   for line in generated_lines[start:end]])
+            section._generated_columns = self._generated_columns[start:end]
+            section._original_sources = self._original_sources[start:end]
+            section._original_lines = self._original_lines[start:end]
+            section._original_columns = self._original_columns[start:end]
+            section._original_names = self._original_names[start:end]
+            section._last_generated_line = section._generated_lines[-1]
+            sections.append((first_line, section))
+            start = end
+        return sections
+
+    def to_index_json(self, section_lines=INDEX_MAP_SECTION_LINES, map=map):
+        """ Like to_json, but as a v3 index map with a section every section_lines
+            generated lines. The sections are serialized independently with map,
+            so passing an executor's map serializes them in parallel.
+        """
+        sections = self.sections(section_lines)
+        index_map = IndexMapGenerator()
+        for (line, _), section_json in zip(sections, map(_section_to_json,
+                                                       [section for _, section in sections])):
+            index_map.add_section(line, 0, section_json)
+        return index_map.to_json()
+
+    def to_binary(self, extra=None):
+        """ The mappings as a binary sourcemap (see BINARY_MAP_MAGIC), which loads much
+            faster than JSON. extra is a dict of other members to keep, like 'file'.
+        """
+        self._sort_mappings()
+        contents = self._sources_content_list()
+        if contents is not None:
+            extra = dict(extra or {})
+            extra['sourcesContent'] = contents
+        return _write_binary_map(self._sources, self._names,
+                                 [getattr(self, attr) for attr in _BINARY_MAP_COLUMNS],
+                                 _line_starts(self._generated_lines), extra)
+
+    @classmethod
+    def from_binary(cls, data):
+        """ A generator holding the mappings of a binary sourcemap, to add more to """
+        sources, names, extra, columns = _read_binary_map(data)
+        smap = cls._from_columns(sources, names, columns)
+        contents = extra.get('sourcesContent')
+        if contents is not None:
+            for source, content in zip(sources, contents):
+                if content is not None:
+                    smap._sources_content.setdefault(source, content)
+        return smap
+
+    @classmethod
+    def _from_columns(cls, sources, names, columns):
+        smap = cls()
+        # not add_source/add_name: the indexes must stay the same even with duplicates
+        smap._sources = list(sources)
+        smap._names = list(names)
+        for i, source in enumerate(sources):
+            smap._source_indexes.setdefault(source, i)
+        for i, name in enumerate(names):
+            smap._name_indexes.setdefault(name, i)
+        for attr, column in zip(_BINARY_MAP_COLUMNS, columns):
+            values = array('i')
+            values.frombytes(memoryview(column).cast('B'))
+            setattr(smap, attr, values)
+        smap._last_generated_line = smap._generated_lines[-1] if len(smap) else 0
+        return smap
+
+    def _serialize_lines(self, end, state):
+        """ Encode the (sorted) mappings [0, end) and return one string per generated line,
+            from state.generatedLine up to the line of the last mapping.
+            state holds the values the deltas are relative to and is updated.
+        """
         previousGeneratedColumn = 0
-        previousGeneratedLine = 1
-        previousOriginalColumn = 0
-        previousOriginalLine = 0
-        previousName = 0
-        previousSource = 0
-        result = ''
-
-        nextStr = ''
-        mapping = None
-        nameIdx = -1
-        sourceIdx = -1
-
-        i = -1
-        # mappings = this._mappings.toArray()
-        # for (i = 0, len = mappings.length i < len i++):
-        #   mapping = mappings[i]
-        for mapping in self._mappings:
-          i += 1
-
-          nextStr = ''
-
-          if (mapping.generatedLine == 0):
+        previousGeneratedLine = state.generatedLine
+        previousOriginalColumn = state.originalColumn
+        previousOriginalLine = state.originalLine
+        previousName = state.name
+        previousSource = state.source
+
+        # Segments of the current generated line; they are joined once the line is done
+        lines = []
+        segments = []
+        previous = None
+
+        table = VLQ_TABLE
+        offset = VLQ_TABLE_OFFSET
+        encode = _encode_vlq
+
+        for current in zip(self._generated_lines[:end], self._generated_columns[:end], self._original_sources[:end],
+                           self._original_lines[:end], self._original_columns[:end], self._original_names[:end]):
+          generatedLine, generatedColumn, sourceIdx, originalLine, originalColumn, nameIdx = current
+
+          if (generatedLine == 0):
               raise ValueError('Mapping contains invalid generatedLine. Line numbers are 1-based')
-          if (mapping.generatedLine != previousGeneratedLine):
+          if (generatedLine != previousGeneratedLine):
             previousGeneratedColumn = 0
-            while (mapping.generatedLine != previousGeneratedLine):
-              nextStr += ';'
-              previousGeneratedLine+=1
-
-          else:
-            if (i > 0):
-              if (not util_compareByGeneratedPositionsInflated(mapping, self._mappings[i - 1])):
-                continue
+            lines.append(','.join(segments))
+            segments = []
+            # Lines without any mappings
+            lines.extend([''] * (generatedLine - previousGeneratedLine - 1))
+            previousGeneratedLine = generatedLine
 
-              nextStr += ','
+          elif (current == previous):
+            # Skip exact duplicates of the previous mapping
+            continue
+          previous = current
 
-          nextStr += base64VLQ_encode(mapping.generatedColumn
-                                     - previousGeneratedColumn)
-          previousGeneratedColumn = mapping.generatedColumn
+          value = generatedColumn - previousGeneratedColumn
+          nextStr = table[value + offset] if -offset <= value < offset else encode(value)
+          previousGeneratedColumn = generatedColumn
 
-          if (mapping.source is not None):
-            # sourceIdx = this._sources.indexOf(mapping.source)
-            sourceIdx = self._sources.index(mapping.source)
-            nextStr += base64VLQ_encode(sourceIdx - previousSource)
+          if (sourceIdx >= 0):
+            value = sourceIdx - previousSource
+            nextStr += table[value + offset] if -offset <= value < offset else encode(value)
             previousSource = sourceIdx
 
             # lines are stored 0-based in SourceMap spec version 3
-            nextStr += base64VLQ_encode(mapping.originalLine - 1
-                                       - previousOriginalLine)
-            previousOriginalLine = mapping.originalLine - 1
+            value = originalLine - 1 - previousOriginalLine
+            nextStr += table[value + offset] if -offset <= value < offset else encode(value)
+            previousOriginalLine = originalLine - 1
 
-            nextStr += base64VLQ_encode(mapping.originalColumn
-                                       - previousOriginalColumn)
-            previousOriginalColumn = mapping.originalColumn
+            value = originalColumn - previousOriginalColumn
+            nextStr += table[value + offset] if -offset <= value < offset else encode(value)
+            previousOriginalColumn = originalColumn
 
-            if (mapping.name is not None):
-              nameIdx = self._names.index(mapping.name)
-              nextStr += base64VLQ_encode(nameIdx - previousName)
+            if (nameIdx >= 0):
+              value = nameIdx - previousName
+              nextStr += table[value + offset] if -offset <= value < offset else encode(value)
               previousName = nameIdx
 
-          result += nextStr
+          segments.append(nextStr)
 
-        return result
+        if end:
+            lines.append(','.join(segments))
+            state.generatedLine = previousGeneratedLine + 1
+        state.originalColumn = previousOriginalColumn
+        state.originalLine = previousOriginalLine
+        state.name = previousName
+        state.source = previousSource
+        return lines
 
-# From https://github.com/mozilla/source-map/blob/master/lib/util.js#L385
-def strcmp(aStr1, aStr2):
-  if (aStr1 == aStr2):
-    return 0
-  if (aStr1 > aStr2):
-    return 1
-  return -1
-def util_compareByGeneratedPositionsInflated(mappingA, mappingB):
-  """
-   * Comparator between two mappings with inflated source and name strings where
-   * the generated positions are compared.
-  """
-  cmp = mappingA.generatedLine - mappingB.generatedLine
-  if (cmp != 0):
-    return cmp
+    def start_stream(self, write, consumer=None, source_file=None):
+        """ Start writing the sourcemap JSON through write() while mappings are still being added.
+            Call flush_mappings() whenever no more mappings will be added before
+            some generated line, and end_stream() once everything is added.
+            Mappings that were written are dropped from the generator.
 
-  cmp = mappingA.generatedColumn - mappingB.generatedColumn
-  if (cmp != 0):
-    return cmp
+            "mappings" is written before "sources" and "names" since those are
+            only known at the end. When consumer is given, mappings into
+            source_file are remapped through it before being written (see apply_source_map).
+        """
+        self._stream = (write, consumer, source_file)
+        self._stream_state = _MappingsState()
+        write('{"version": 3, "mappings": "')
 
-  cmp = strcmp(mappingA.source, mappingB.source)
-  if (cmp != 0):
-    return cmp
+    def flush_mappings(self, before_line=None):
+        """ Write the mappings for generated lines before before_line (all of them by default) """
+        write, consumer, source_file = self._stream
+        self._sort_mappings()
+        if before_line is None:
+            end = len(self)
+        else:
+            end = bisect.bisect_left(self._generated_lines, before_line)
+        if not end:
+            return
+        if consumer is not None and source_file in self._source_indexes:
+            self._remap_mappings(consumer, self._source_indexes[source_file], end)
+        state = self._stream_state
+        separator = ';' if state.generatedLine > 1 else ''
+        write(separator + ';'.join(self._serialize_lines(end, state)))
+        for column in (self._generated_lines, self._generated_columns, self._original_sources,
+                       self._original_lines, self._original_columns, self._original_names):
+            del column[:end]
 
-  cmp = mappingA.originalLine - mappingB.originalLine
-  if (cmp != 0):
-    return cmp
+    def end_stream(self):
+        """ Write the remaining mappings and finish the JSON started by start_stream() """
+        self.flush_mappings()
+        write = self._stream[0]
+        write('", "sources": ' + json.dumps(self._sources))
+        contents = self._sources_content_list()
+        if len(self._names) > 0 or contents is not None:
+            write(', "names": ' + json.dumps(self._names))
+        if contents is not None:
+            write(', "sourcesContent": ' + json.dumps(contents))
+        write('}')
+        self._stream = self._stream_state = None
 
-  cmp = mappingA.originalColumn - mappingB.originalColumn
-  if (cmp != 0):
-    return cmp
 
-  return strcmp(mappingA.name, mappingB.name)
+class _MappingsState(object):
+    """ The previous values that serialized VLQ deltas are relative to """
+    __slots__ = ('generatedLine', 'source', 'originalLine', 'originalColumn', 'name')
 
+    def __init__(self):
+        self.generatedLine = 1
+        self.source = 0
+        self.originalLine = 0
+        self.originalColumn = 0
+        self.name = 0
 
-@contextlib.contextmanager
-def _get_writer(file_or_filename, encoding):
-    # returns text write method and release all resources after using
-    try:
-        write = file_or_filename.write
-    except AttributeError:
-        # file_or_filename is a file name
-        if encoding == "unicode":
-            file = open(file_or_filename, "w")
+
+def _section_to_json(smap):
+    """ SourceMapGenerator.to_json as a module function, so executors can pickle it """
+    return smap.to_json()
+
+
+class IndexMapGenerator(object):
+    """ Stitches independently generated sourcemaps into a v3 index map.
+
+        Each section is a complete sourcemap for the generated code starting at
+        its offset. The section maps are copied into the output as JSON text,
+        so stitching costs O(sections) and never re-encodes mappings.
+    """
+    def __init__(self, file=None):
+        self.file = file
+        # (0-based line, column, map JSON)
+        self._sections = []
+
+    def __len__(self):
+        return len(self._sections)
+
+    def add_section(self, line, column, source_map):
+        """ Add source_map (a SourceMapGenerator, dict or JSON string) for the generated
+            code starting at line (1-based) and column (0-based). Sections must be
+            added in generated order.
+        """
+        if isinstance(source_map, SourceMapGenerator):
+            source_map = source_map.to_json()
+        elif isinstance(source_map, dict):
+            source_map = json.dumps(source_map)
+        offset = (line - 1, column)
+        if line < 1 or column < 0:
+            raise ValueError('Invalid section offset %d:%d' % (line, column))
+        if self._sections and offset <= self._sections[-1][:2]:
+            raise ValueError('Section %d:%d is not after the previous section' % (line, column))
+        self._sections.append(offset + (source_map,))
+
+    def to_json(self):
+        parts = ['{"version": 3, ']
+        if self.file is not None:
+            parts.append('"file": %s, ' % json.dumps(self.file))
+        parts.append('"sections": [')
+        parts.append(', '.join('{"offset": {"line": %d, "column": %d}, "map": %s}' % section
+                               for section in self._sections))
+        parts.append(']}')
+        return ''.join(parts)
+
+
+class SourceMapConcatenator(object):
+    """ Merges the sourcemaps of outputs that are concatenated into one output.
+
+        Add each output's text and sourcemap in order, then to_json() gives one
+        flat v3 map. The mappings strings are spliced, not decoded: since
+        source, original line/column and name are deltas that carry on from one
+        segment to the next, only the first segment of a map with a source (and
+        the first with a name) is re-encoded against the state the previous maps
+        ended in, and the first segment of a map whose text continues an
+        unfinished line gets shifted. That end state is a sum of deltas, so it
+        is computed from the distinct segments and their counts. A map whose
+        sources (or names) were already seen, so its indexes do not simply
+        shift, is decoded and re-encoded with the merged indexes.
+    """
+    # Decoded segment strings kept for reuse, the maps share most of them
+    SEGMENT_CACHE = 65536
+
+    def __init__(self, file=None):
+        self.file = file
+        # segment -> decoded values, and -> (source, original line, original column,
+        # name deltas, has a source, has a name)
+        self._segments = {}
+        self._deltas = {}
+        self._sources = []
+        self._names = []
+        self._source_indexes = {}
+        self._name_indexes = {}
+        # source -> its embedded text (sourcesContent), from the first map embedding it
+        self._sources_content = {}
+        # mappings of each generated line, the last one is still open
+        self._lines = ['']
+        # length of the open line and column of its last segment (0 without any)
+        self._column = 0
+        self._last_column = 0
+        # source, original line (0-based), original column and name the next deltas
+        # are relative to
+        self._state = [0, 0, 0, 0]
+
+    def __len__(self):
+        return len(self._lines)
+
+    def _indexes(self, items, merged, indexes):
+        """ Merged indexes of items, and their common offset (None when there is none) """
+        result = []
+        for item in items:
+            try:
+                result.append(indexes[item])
+            except KeyError:
+                idx = indexes[item] = len(merged)
+                merged.append(item)
+                result.append(idx)
+        offset = result[0] if result else 0
+        if result != list(range(offset, offset + len(result))):
+            return result, None
+        return result, offset
+
+    def add(self, text, source_map=None):
+        """ Append the output text and its sourcemap (a SourceMapGenerator, dict or JSON
+            string; None when nothing in text is mapped)
+        """
+        text_lines = text.count("\n") + 1
+        mappings = ''
+        source_offset = name_offset = 0
+        if source_map is not None:
+            if isinstance(source_map, SourceMapGenerator):
+                source_map = source_map.to_json()
+            if not isinstance(source_map, dict):
+                source_map = json.loads(source_map)
+            if 'sections' in source_map:
+                raise ValueError('Index maps cannot be concatenated, flatten them first')
+            if source_map.get('version') != 3:
+                raise ValueError('Unsupported sourcemap version: %r' % source_map.get('version'))
+            mappings = source_map.get('mappings', '')
+            contents = source_map.get('sourcesContent')
+            for i, source in enumerate(source_map.get('sources', [])):
+                content = _source_content(contents, i)
+                if content is not None:
+                    self._sources_content.setdefault(source, content)
+            sources, source_offset = self._indexes(source_map.get('sources', []),
+                                                   self._sources, self._source_indexes)
+            names, name_offset = self._indexes(source_map.get('names', []),
+                                               self._names, self._name_indexes)
+            if source_offset is None or name_offset is None:
+                mappings = self._reindexed(mappings, sources, names)
+                source_offset = name_offset = 0
+        lines = mappings.split(';')
+        if len(lines) > text_lines:
+            raise ValueError('The sourcemap has mappings past the end of the text')
+
+        # where the deltas of this map end up (they start from 0): the sum of the
+        # deltas of each distinct segment times how often it occurs
+        counts = collections.Counter(mappings.replace(';', ',').split(','))
+        counts.pop('', None)
+        decoded = self._segments
+        if len(decoded) >= self.SEGMENT_CACHE:
+            decoded.clear()
+            self._deltas.clear()
+        get = self._deltas.get
+        deltas = [get(segment) or self._decode(segment) for segment in counts]
+        ends = [sum(map(operator.mul, counts.values(), column)) for column in zip(*deltas)]
+        has_source = bool(ends and ends[4])
+        has_name = bool(ends and ends[5])
+
+        last = lines[-1] if len(lines) == text_lines else ''
+        last_column = sum(decoded[segment][0] for segment in last.split(',') if segment)
+        self._rebase(lines, decoded, source_offset, name_offset, has_source, has_name)
+
+        merged = self._lines
+        if lines[0] and merged[-1]:
+            merged[-1] += ',' + lines[0]
+        elif lines[0]:
+            merged[-1] = lines[0]
+        merged.extend(lines[1:])
+        merged.extend([''] * (text_lines - len(lines)))
+
+        state = self._state
+        if has_source:
+            state[0] = source_offset + ends[0]
+            state[1] = ends[1]
+            state[2] = ends[2]
+        if has_name:
+            state[3] = name_offset + ends[3]
+        if text_lines == 1:
+            if last:
+                self._last_column = self._column + last_column
+            self._column += len(text)
         else:
-            file = open(file_or_filename, "w", encoding=encoding,
-                        errors="xmlcharrefreplace")
-        with file:
-            yield file.write
-    else:
-        # file_or_filename is a file-like object
-        # encoding determines if it is a text or binary writer
-        if encoding == "unicode":
-            # use a text writer as is
-            yield write
+            self._last_column = last_column
+            self._column = len(text) - text.rfind("\n") - 1
+
+    def _decode(self, segment):
+        values = self._segments[segment] = _decode_segment(segment)
+        if len(values) == 1:
+            deltas = (0, 0, 0, 0, 0, 0)
+        elif len(values) == 4:
+            deltas = (values[1], values[2], values[3], 0, 1, 0)
         else:
-            # wrap a binary writer with TextIOWrapper
-            with contextlib.ExitStack() as stack:
-                if isinstance(file_or_filename, io.BufferedIOBase):
-                    file = file_or_filename
-                elif isinstance(file_or_filename, io.RawIOBase):
-                    file = io.BufferedWriter(file_or_filename)
-                    # Keep the original file open when the BufferedWriter is
-                    # destroyed
-                    stack.callback(file.detach)
-                else:
-                    # This is to handle passed objects that aren't in the
-                    # IOBase hierarchy, but just have a write method
-                    file = io.BufferedIOBase()
-                    file.writable = lambda: True
-                    file.write = write
-                    try:
-                        # TextIOWrapper uses this methods to determine
-                        # if BOM (for UTF-16, etc) should be added
-                        file.seekable = file_or_filename.seekable
-                        file.tell = file_or_filename.tell
-                    except AttributeError:
-                        pass
-                file = io.TextIOWrapper(file,
-                                        encoding=encoding,
-                                        errors="xmlcharrefreplace",
-                                        newline="\n")
-                # Keep the original file open when the TextIOWrapper is
-                # destroyed
-                stack.callback(file.detach)
-                yield file.write
+            deltas = (values[1], values[2], values[3], values[4], 1, 1)
+        self._deltas[segment] = deltas
+        return deltas
 
-def _escape_cdata(text):
+    def _rebase(self, lines, decoded, source_offset, name_offset, has_source, has_name):
+        """ Re-encode the segments of lines (in place) whose deltas change when the map
+            is appended: the first one (for the column), the first with a source
+            and the first with a name.
+        """
+        shift_column = self._column - self._last_column
+        need_source = has_source
+        need_name = has_name
+        state = self._state
+        for i, line in enumerate(lines):
+            if not (need_source or need_name or shift_column):
+                break
+            segments = line.split(',')
+            changed = False
+            for j, segment in enumerate(segments):
+                if not segment:
+                    continue
+                values = list(decoded[segment])
+                if shift_column:
+                    # the first segment of the first line
+                    values[0] += shift_column
+                    shift_column = 0
+                if need_source and len(values) > 1:
+                    values[1] += source_offset - state[0]
+                    values[2] -= state[1]
+                    values[3] -= state[2]
+                    need_source = False
+                if need_name and len(values) == 5:
+                    values[4] += name_offset - state[3]
+                    need_name = False
+                if values != decoded[segment]:
+                    segments[j] = ''.join(base64VLQ_encode(value) for value in values)
+                    changed = True
+                if not (need_source or need_name):
+                    break
+            if changed:
+                lines[i] = ','.join(segments)
+            shift_column = 0
+
+    @staticmethod
+    def _reindexed(mappings, sources, names):
+        """ mappings with source index i replaced by sources[i] and name index i by names[i] """
+        columns = _decode_mappings(mappings)
+        original_sources = columns[2]
+        original_names = columns[5]
+        for i, (src_idx, name_idx) in enumerate(zip(original_sources, original_names)):
+            if src_idx >= 0:
+                original_sources[i] = sources[src_idx]
+            if name_idx >= 0:
+                original_names[i] = names[name_idx]
+        smap = SourceMapGenerator()
+        (smap._generated_lines, smap._generated_columns, smap._original_sources,
+         smap._original_lines, smap._original_columns, smap._original_names) = columns
+        return smap.serializeMappings()
+
+    def to_json(self):
+        obj = {'version': 3}
+        if self.file is not None:
+            obj['file'] = self.file
+        obj['sources'] = self._sources
+        if self._names or self._sources_content:
+            obj['names'] = self._names
+        obj['mappings'] = ';'.join(self._lines).rstrip(';')
+        if self._sources_content:
+            obj['sourcesContent'] = [self._sources_content.get(source) for source in self._sources]
+        return json.dumps(obj)
+
+
+# Below this many mappings the NumPy setup costs more than it saves
+NUMPY_MIN_MAPPINGS = 4096
+
+def _vlq_encode_column(deltas):
+  """ Encode a NumPy array of deltas into an object array of VLQ strings """
+  encoded = numpy.array(VLQ_TABLE, dtype=object)[numpy.clip(deltas + VLQ_TABLE_OFFSET, 0, 2 * VLQ_TABLE_OFFSET - 1)]
+  for i in numpy.flatnonzero((deltas < -VLQ_TABLE_OFFSET) | (deltas >= VLQ_TABLE_OFFSET)).tolist():
+    encoded[i] = _encode_vlq(int(deltas[i]))
+  return encoded
+
+def _serialize_mappings_numpy(generated_lines, generated_columns, original_sources,
+                              original_lines, original_columns, original_names):
+  """
+   Same output as SourceMapGenerator.serializeMappings but the deltas of every
+   column are computed at once with NumPy. The mappings must already be sorted.
+  """
+  columns = [numpy.frombuffer(c, dtype=numpy.intc).astype(numpy.int64) for c in (
+      generated_lines, generated_columns, original_sources,
+      original_lines, original_columns, original_names)]
+  if (columns[0] == 0).any():
+    raise ValueError('Mapping contains invalid generatedLine. Line numbers are 1-based')
+
+  # Skip exact duplicates of the previous mapping
+  keep = numpy.ones(len(columns[0]), dtype=bool)
+  keep[1:] = numpy.any([c[1:] != c[:-1] for c in columns], axis=0)
+  gen_line, gen_col, source, orig_line, orig_col, name = [c[keep] for c in columns]
+
+  # generated columns are relative to the previous mapping on the same line
+  new_line = numpy.ones(len(gen_line), dtype=bool)
+  new_line[1:] = gen_line[1:] != gen_line[:-1]
+  gen_col_delta = gen_col.copy()
+  gen_col_delta[~new_line] -= gen_col[:-1][~new_line[1:]]
+  segments = _vlq_encode_column(gen_col_delta)
+
+  # everything else is relative to the previous mapping that has the same field
+  has_source = source >= 0
+  has_name = has_source & (name >= 0)
+  for rows, values in ((has_source, source), (has_source, orig_line - 1),
+                       (has_source, orig_col), (has_name, name)):
+    field = numpy.full(len(gen_line), '', dtype=object)
+    field[rows] = _vlq_encode_column(numpy.diff(values[rows], prepend=0))
+    segments += field
+
+  lines = []
+  segments = segments.tolist()
+  previous_line = 1
+  starts = numpy.flatnonzero(new_line).tolist() + [len(segments)]
+  line_numbers = gen_line.tolist()
+  for start, end in zip(starts, starts[1:]):
+    line = line_numbers[start]
+    # Lines without any mappings (and the first line if it has none)
+    lines.extend([''] * (line - previous_line))
+    lines.append(','.join(segments[start:end]))
+    previous_line = line + 1
+  if not lines:
+    return ''
+  return ';'.join(lines)
+
+
+# Loosely follows https://github.com/mozilla/source-map/blob/master/lib/source-map-consumer.js
+class SourceMapConsumer:
+    """ Read a v3 sourcemap and answer position lookups.
+
+        The mappings are decoded once into sorted array('i') columns.
+        original_position_for finds the line with an index and then bisects the
+        generated columns of that line; generated_positions_for uses a reverse
+        index by original position which is built the first time it is needed.
+        Lines are 1-based and columns are 0-based, like mozilla/source-map.
+    """
+    def __init__(self, source_map):
+        if not isinstance(source_map, dict):
+            source_map = json.loads(source_map)
+        if source_map.get('version') != 3:
+            raise ValueError('Unsupported sourcemap version: %r' % source_map.get('version'))
+        self.file = source_map.get('file')
+        self.sources = list(source_map.get('sources', []))
+        self.names = list(source_map.get('names', []))
+        self._source_indexes = dict((source, i) for i, source in enumerate(self.sources))
+        self._sources_content = source_map.get('sourcesContent')
+
+        (self._generated_lines, self._generated_columns, self._original_sources,
+         self._original_lines, self._original_columns, self._original_names) = \
+            _decode_mappings(source_map.get('mappings', ''))
+
+        self._line_starts = _line_starts(self._generated_lines)
+        self._original_index = None
+
+    @classmethod
+    def from_file(cls, file_or_filename):
+        """ Load a sourcemap from a file name or an open file.
+            An index map is loaded as an IndexMapConsumer, a binary map with from_binary.
+            Embedded sources (sourcesContent) are decoded when source_content_for
+            first asks for them.
+        """
+        try:
+            # the bytes under a text file, binary maps are not UTF-8
+            read = getattr(file_or_filename, 'buffer', file_or_filename).read
+        except AttributeError:
+            with open(file_or_filename, 'rb') as f:
+                data = f.read()
+        else:
+            data = read()
+        if data[:len(BINARY_MAP_MAGIC)] == BINARY_MAP_MAGIC:
+            return cls.from_binary(data)
+        return load_source_map(_json_map(data))
+
+    @classmethod
+    def from_binary(cls, data):
+        """ Load a binary sourcemap (see SourceMapGenerator.to_binary) from bytes or an mmap.
+            Nothing is decoded or copied: the mappings are memoryviews of data.
+        """
+        sources, names, extra, columns = _read_binary_map(data)
+        consumer = cls.__new__(cls)
+        consumer.file = extra.get('file')
+        consumer.sources = sources
+        consumer.names = names
+        consumer._source_indexes = dict((source, i) for i, source in enumerate(sources))
+        consumer._sources_content = extra.get('sourcesContent')
+        (consumer._generated_lines, consumer._generated_columns, consumer._original_sources,
+         consumer._original_lines, consumer._original_columns, consumer._original_names,
+         consumer._line_starts) = columns
+        consumer._original_index = None
+        return consumer
+
+    def __len__(self):
+        return len(self._generated_lines)
+
+    def source_content_for(self, source):
+        """ The text of source embedded in the sourcemap (sourcesContent), or None.
+            Like mozilla's sourceContentFor; an entry is only decoded when first asked for.
+        """
+        return _source_content(self._sources_content, self._source_indexes.get(source))
+
+    def _position(self, idx):
+        src_idx = self._original_sources[idx]
+        if src_idx < 0:
+            return {'source': None, 'line': None, 'column': None, 'name': None}
+        name_idx = self._original_names[idx]
+        return {
+            'source': self.sources[src_idx],
+            'line': self._original_lines[idx],
+            'column': self._original_columns[idx],
+            'name': self.names[name_idx] if name_idx >= 0 else None,
+        }
+
+    def _find_mapping(self, line, column):
+        """ Index of the last mapping on the generated line at or before column, or -1 """
+        if line < 1 or line + 1 >= len(self._line_starts):
+            return -1
+        lo = self._line_starts[line]
+        idx = bisect.bisect_right(self._generated_columns, column, lo, self._line_starts[line + 1]) - 1
+        return idx if idx >= lo else -1
+
+    def _find_original(self, line, column):
+        """ (source index, line, column, name index) for a generated position, or None """
+        idx = self._find_mapping(line, column)
+        if idx < 0 or self._original_sources[idx] < 0:
+            return None
+        return (self._original_sources[idx], self._original_lines[idx],
+                self._original_columns[idx], self._original_names[idx])
+
+    def original_position_for(self, line, column):
+        """ Return the original source, line, column and name for a generated position.
+            All of them are None when the position is not mapped.
+        """
+        idx = self._find_mapping(line, column)
+        if idx < 0:
+            return {'source': None, 'line': None, 'column': None, 'name': None}
+        return self._position(idx)
+
+    def lookup_many(self, positions):
+        """ original_position_for for each (line, column) in positions, returned as a list """
+        find = self._find_mapping
+        position = self._position
+        not_found = {'source': None, 'line': None, 'column': None, 'name': None}
+        results = []
+        for line, column in positions:
+            idx = find(line, column)
+            results.append(position(idx) if idx >= 0 else dict(not_found))
+        return results
+
+    def _build_original_index(self):
+        # (source index, original line) -> mapping indexes sorted by original column
+        index = {}
+        for idx, key in enumerate(zip(self._original_sources, self._original_lines)):
+            if key[0] >= 0:
+                index.setdefault(key, []).append(idx)
+        columns = self._original_columns
+        for idxs in index.values():
+            idxs.sort(key=columns.__getitem__)
+        self._original_index = index
+
+    def generated_positions_for(self, source, line, column=None):
+        """ Return all generated positions for an original position as a list of
+            {'line': .., 'column': ..}. Without a column every mapping on the original
+            line is returned. When nothing maps to exactly that column, the mappings
+            for the closest column after it are returned instead.
+        """
+        idxs, _ = self._generated_matches(source, line, column)
+        return [{'line': self._generated_lines[idx], 'column': self._generated_columns[idx]}
+                for idx in idxs]
+
+    def _generated_matches(self, source, line, column=None):
+        """ The mapping indexes generated_positions_for returns, and the original
+            column they matched (None when column is None or nothing matched)
+        """
+        src_idx = self._source_indexes.get(source)
+        if src_idx is None:
+            return [], None
+        if self._original_index is None:
+            self._build_original_index()
+        idxs = self._original_index.get((src_idx, line), [])
+        if column is None or not idxs:
+            return idxs, None
+        original_columns = [self._original_columns[idx] for idx in idxs]
+        lo = bisect.bisect_left(original_columns, column)
+        if lo == len(idxs):
+            return [], None
+        hi = bisect.bisect_right(original_columns, original_columns[lo], lo)
+        return idxs[lo:hi], original_columns[lo]
+
+
+class IndexMapConsumer(object):
+    """ Read a v3 index map (a sourcemap made of "sections") and answer the same
+        lookups as SourceMapConsumer.
+
+        The mappings of a section are only decoded when a lookup first needs that
+        section. Sections are found by bisecting their offsets. Every section
+        must embed its map; sections with a "url" are not supported.
+    """
+    def __init__(self, source_map):
+        if not isinstance(source_map, dict):
+            source_map = json.loads(source_map)
+        if source_map.get('version') != 3:
+            raise ValueError('Unsupported sourcemap version: %r' % source_map.get('version'))
+        self.file = source_map.get('file')
+        self.sources = []
+        self.names = []
+        self._source_indexes = {}
+        name_indexes = {}
+        # 0-based (line, column) of each section, the raw section maps and their consumers
+        self._offsets = []
+        self._maps = []
+        self._consumers = []
+        # decodes a section once when threads look it up together
+        self._lock = threading.Lock()
+        # section source/name index -> index into self.sources/self.names
+        self._section_sources = []
+        self._section_names = []
+        # source index -> (sourcesContent of the first section embedding it, index in it)
+        self._sources_content = {}
+        for section in source_map.get('sections', []):
+            if 'map' not in section:
+                raise ValueError('Index map sections with a url are not supported')
+            section_map = section['map']
+            if 'sections' in section_map:
+                raise ValueError('Index map sections cannot be index maps themselves')
+            offset = (section['offset']['line'], section['offset']['column'])
+            if self._offsets and offset <= self._offsets[-1]:
+                raise ValueError('Index map sections are not in order at %d:%d' % offset)
+            self._offsets.append(offset)
+            self._maps.append(section_map)
+            self._consumers.append(None)
+            sources = []
+            contents = section_map.get('sourcesContent')
+            for i, source in enumerate(section_map.get('sources', [])):
+                if source not in self._source_indexes:
+                    self._source_indexes[source] = len(self.sources)
+                    self.sources.append(source)
+                src_idx = self._source_indexes[source]
+                sources.append(src_idx)
+                if src_idx not in self._sources_content and _source_content(contents, i) is not None:
+                    self._sources_content[src_idx] = (contents, i)
+            self._section_sources.append(sources)
+            names = []
+            for name in section_map.get('names', []):
+                if name not in name_indexes:
+                    name_indexes[name] = len(self.names)
+                    self.names.append(name)
+                names.append(name_indexes[name])
+            self._section_names.append(names)
+
+    def __len__(self):
+        return sum(len(self._section(i)) for i in range(len(self._offsets)))
+
+    def source_content_for(self, source):
+        """ See SourceMapConsumer.source_content_for """
+        found = self._sources_content.get(self._source_indexes.get(source))
+        return _source_content(*found) if found is not None else None
+
+    def _section(self, i):
+        consumer = self._consumers[i]
+        if consumer is None:
+            with self._lock:
+                consumer = self._consumers[i]
+                if consumer is None:
+                    consumer = self._consumers[i] = SourceMapConsumer(self._maps[i])
+                    # the decoded columns replace the mappings string
+                    self._maps[i] = None
+        return consumer
+
+    def _find_original(self, line, column):
+        """ (source index, line, column, name index) for a generated position, or None """
+        i = bisect.bisect_right(self._offsets, (line - 1, column)) - 1
+        if i < 0:
+            return None
+        offset_line, offset_column = self._offsets[i]
+        if line - 1 == offset_line:
+            column -= offset_column
+        found = self._section(i)._find_original(line - offset_line, column)
+        if found is None:
+            return None
+        src_idx, original_line, original_column, name_idx = found
+        if name_idx >= 0:
+            name_idx = self._section_names[i][name_idx]
+        return self._section_sources[i][src_idx], original_line, original_column, name_idx
+
+    def original_position_for(self, line, column):
+        """ See SourceMapConsumer.original_position_for """
+        found = self._find_original(line, column)
+        if found is None:
+            return {'source': None, 'line': None, 'column': None, 'name': None}
+        src_idx, original_line, original_column, name_idx = found
+        return {
+            'source': self.sources[src_idx],
+            'line': original_line,
+            'column': original_column,
+            'name': self.names[name_idx] if name_idx >= 0 else None,
+        }
+
+    def lookup_many(self, positions):
+        """ original_position_for for each (line, column) in positions, returned as a list """
+        return [self.original_position_for(line, column) for line, column in positions]
+
+    def generated_positions_for(self, source, line, column=None):
+        """ See SourceMapConsumer.generated_positions_for """
+        if source not in self._source_indexes:
+            return []
+        src_idx = self._source_indexes[source]
+        positions = []
+        best = None
+        for i, (offset_line, offset_column) in enumerate(self._offsets):
+            if src_idx not in self._section_sources[i]:
+                continue
+            consumer = self._section(i)
+            idxs, matched = consumer._generated_matches(source, line, column)
+            if not idxs:
+                continue
+            if column is not None:
+                # keep only the closest original column over all sections
+                if best is not None and matched > best:
+                    continue
+                if best is None or matched < best:
+                    best = matched
+                    positions = []
+            for idx in idxs:
+                generated_line = consumer._generated_lines[idx]
+                generated_column = consumer._generated_columns[idx]
+                if generated_line == 1:
+                    generated_column += offset_column
+                positions.append({'line': generated_line + offset_line,
+                                  'column': generated_column})
+        return positions
+
+
+def load_source_map(source_map):
+    """ A SourceMapConsumer, or an IndexMapConsumer for an index map.
+        source_map is a dict or a JSON string.
+    """
+    if not isinstance(source_map, dict):
+        source_map = json.loads(source_map)
+    if 'sections' in source_map:
+        return IndexMapConsumer(source_map)
+    return SourceMapConsumer(source_map)
+
+
+_JSON_STRUCTURE_RE = re.compile(rb'["\[\]{}]')
+_JSON_SCALAR_RE = re.compile(rb'[^,}\]\s]*')
+_JSON_WHITESPACE_RE = re.compile(rb'\s*')
+
+
+def _json_string_end(buf, pos):
+    """ Index just past the JSON string starting at buf[pos] (a quote) """
+    start = pos + 1
+    while True:
+        end = buf.find(b'"', start)
+        if end < 0:
+            raise ValueError('Unterminated JSON string at %d' % pos)
+        backslash = end
+        while buf[backslash - 1] == 0x5c:  # backslash
+            backslash -= 1
+        if (end - backslash) % 2 == 0:
+            return end + 1
+        start = end + 1
+
+
+def _json_value_end(buf, pos):
+    """ Index just past the JSON value starting at buf[pos], without decoding it """
+    char = buf[pos:pos + 1]
+    if char == b'"':
+        return _json_string_end(buf, pos)
+    if char not in (b'[', b'{'):
+        return _JSON_SCALAR_RE.match(buf, pos).end()
+    depth = 0
+    while True:
+        match = _JSON_STRUCTURE_RE.search(buf, pos)
+        if match is None:
+            raise ValueError('Unterminated JSON value')
+        char = match.group()
+        if char == b'"':
+            pos = _json_string_end(buf, match.start())
+            continue
+        pos = match.end()
+        depth += 1 if char in (b'[', b'{') else -1
+        if depth == 0:
+            return pos
+
+
+def _json_members(buf, stop=None):
+    """ Yield (key, value start, value end) for the members of the JSON object in buf.
+        The member named stop is yielded with an end of None, and ends the scan.
+    """
+    skip = _JSON_WHITESPACE_RE.match
+    pos = skip(buf, 0).end()
+    if buf[pos:pos + 1] != b'{':
+        raise ValueError('Expected a JSON object')
+    pos = skip(buf, pos + 1).end()
+    if buf[pos:pos + 1] == b'}':
+        return
+    while True:
+        end = _json_string_end(buf, pos)
+        key = json.loads(bytes(buf[pos:end]))
+        pos = skip(buf, end).end()
+        if buf[pos:pos + 1] != b':':
+            raise ValueError('Expected ":" at %d' % pos)
+        pos = skip(buf, pos + 1).end()
+        if key == stop:
+            yield key, pos, None
+            return
+        end = _json_value_end(buf, pos)
+        yield key, pos, end
+        pos = skip(buf, end).end()
+        if buf[pos:pos + 1] == b'}':
+            return
+        if buf[pos:pos + 1] != b',':
+            raise ValueError('Expected "," at %d' % pos)
+        pos = skip(buf, pos + 1).end()
+
+
+# The end of a string entry of a JSON array, unless its quote is escaped
+_JSON_ENTRY_END_RE = re.compile(rb'"\s*[,\]]')
+
+
+class _SourcesContent(object):
+    """ The "sourcesContent" array of a sourcemap, left encoded in buf (bytes, an
+        mmap or a memoryview) where it starts at start (its "[").
+
+        Embedded sources can be much bigger than the rest of the map, and a lookup
+        rarely needs them. So the array is not even scanned when the map is
+        loaded: entries are located only up to the one asked for, and each one is
+        decoded (once) when it is asked for. Index it like the list it stands for;
+        it can be shared between threads.
+    """
+    def __init__(self, buf, start):
+        self._lock = threading.Lock()
+        self._buf = buf
+        self._pos = _JSON_WHITESPACE_RE.match(buf, start + 1).end()
+        self._done = buf[self._pos:self._pos + 1] == b']'
+        # (start, end) of the entries located so far
+        self._spans = []
+        self._decoded = {}
+
+    def _locate_next(self):
+        buf = self._buf
+        start = pos = self._pos
+        if buf[pos:pos + 1] == b'"':
+            while True:
+                match = _JSON_ENTRY_END_RE.search(buf, pos + 1)
+                if match is None:
+                    raise ValueError('Unterminated JSON string at %d' % start)
+                pos = match.start()
+                backslash = pos
+                while buf[backslash - 1] == 0x5c:  # backslash
+                    backslash -= 1
+                if (pos - backslash) % 2 == 0:
+                    break
+            end = pos + 1
+        else:
+            end = _JSON_SCALAR_RE.match(buf, pos).end()
+        self._spans.append((start, end))
+        pos = _JSON_WHITESPACE_RE.match(buf, end).end()
+        char = buf[pos:pos + 1]
+        if char == b']':
+            self._done = True
+        elif char == b',':
+            self._pos = _JSON_WHITESPACE_RE.match(buf, pos + 1).end()
+        else:
+            raise ValueError('Expected "," at %d' % pos)
+
+    def __getitem__(self, index):
+        try:
+            return self._decoded[index]
+        except KeyError:
+            pass
+        if index < 0:
+            raise IndexError(index)
+        with self._lock:
+            if index in self._decoded:
+                return self._decoded[index]
+            while len(self._spans) <= index and not self._done:
+                self._locate_next()
+            if index >= len(self._spans):
+                raise IndexError(index)
+            start, end = self._spans[index]
+            content = self._decoded[index] = json.loads(bytes(self._buf[start:end]))
+            return content
+
+
+def _json_map(buf, required=None):
+    """ json.loads for a sourcemap (or another object) in buf, except that its
+        "sourcesContent" is left encoded as a _SourcesContent.
+        The members after sourcesContent are not read, so that only works if the
+        required members came before it (as they do in the maps of this module
+        and of mozilla/source-map); otherwise all of buf is decoded.
+    """
+    if buf.find(b'"sourcesContent"') < 0 or buf.find(b'"sections"') >= 0:
+        # (index maps embed it in their sections)
+        return json.loads(bytes(buf))
+    if required is None:
+        required = _JSON_MAP_MEMBERS
+    obj = {}
+    for key, start, end in _json_members(buf, 'sourcesContent'):
+        if end is not None:
+            obj[key] = json.loads(bytes(buf[start:end]))
+        elif all(member in obj for member in required):
+            obj[key] = _SourcesContent(buf, start)
+        else:
+            return json.loads(bytes(buf))
+    return obj
+
+
+def _source_content(contents, source_idx):
+    """ Entry source_idx of a sourcesContent list (or _SourcesContent), or None """
+    if contents is None or source_idx is None:
+        return None
+    try:
+        return contents[source_idx]
+    except IndexError:
+        return None
+
+
+def source_snippets(consumer, originals, context=0):
+    """ For each position from consumer.lookup_many/original_position_for, the
+        original lines around it (context lines before and after) as a list, from
+        the sourcesContent of consumer. None when the position is not mapped
+        or its source is not embedded.
+    """
+    lines = {}
+    snippets = []
+    for original in originals:
+        source = original['source']
+        if source not in lines:
+            content = consumer.source_content_for(source) if source is not None else None
+            lines[source] = content.split("\n") if content is not None else None
+        source_lines = lines[source]
+        if source_lines is None:
+            snippets.append(None)
+            continue
+        line = original['line'] - 1
+        snippets.append(source_lines[max(line - context, 0):line + context + 1])
+    return snippets
+
+
+class LazySourceMapConsumer(object):
+    """ Answer lookups in a (huge) v3 sourcemap file without loading it.
+
+        The file is memory-mapped. Only the small members (version, file,
+        sources, names) are decoded; the mappings string is left in the file.
+        Because segments are relative to the previous segment (across lines too),
+        a line cannot be decoded without the running source/line/column/name
+        at its start. The index keeps the offset of and that state at every
+        CHECKPOINT_LINES-th line and grows on demand, as far as the lookups go.
+        Looking up line L the first time costs one pass over the mappings up to
+        L; after that, at most CHECKPOINT_LINES lines are scanned. Decoded lines
+        are kept in an LRU cache of cache_lines lines.
+
+        Index maps and binary maps are not supported (ValueError), use
+        SourceMapConsumer.from_file for those.
+    """
+    CHECKPOINT_LINES = 64
+    # Decoded segment strings kept for reuse, like _decode_mappings does
+    SEGMENT_CACHE = 65536
+
+    def __init__(self, filename, cache_lines=1024):
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(BINARY_MAP_MAGIC)] == BINARY_MAP_MAGIC:
+            self._mmap.close()
+            raise ValueError('%s is a binary sourcemap' % filename)
+        members = {}
+        for key, start, end in _json_members(self._mmap, 'sourcesContent'):
+            members[key] = (start, end)
+        if 'sourcesContent' in members and not all(key in members for key in _JSON_MAP_MEMBERS):
+            # some come after it (see _json_map), scan everything
+            members = dict((key, (start, end)) for key, start, end in _json_members(self._mmap))
+        if 'sections' in members:
+            raise ValueError('%s is an index map' % filename)
+
+        def member(key, default=None):
+            if key not in members:
+                return default
+            start, end = members[key]
+            return json.loads(self._mmap[start:end])
+
+        if member('version') != 3:
+            raise ValueError('Unsupported sourcemap version: %r' % member('version'))
+        self.file = member('file')
+        self.sources = list(member('sources', []))
+        self.names = list(member('names', []))
+        self._source_indexes = dict((source, i) for i, source in enumerate(self.sources))
+        self._sources_content = None
+        if 'sourcesContent' in members:
+            self._sources_content = _SourcesContent(self._mmap, members['sourcesContent'][0])
+        start, end = members.get('mappings', (0, 0))
+        # the mappings string without its quotes (VLQ has nothing to escape)
+        self._mappings_start = start + 1 if end else 0
+        self._mappings_end = end - 1 if end else 0
+
+        # offset of the first line after each checkpoint, and the running
+        # (source, original line, original column, name) at it
+        self._checkpoint_offsets = array('q', [self._mappings_start])
+        self._checkpoint_states = array('i', [0, 0, 0, 0])
+        self._indexed_to_end = self._mappings_start >= self._mappings_end
+        self._segments = {}
+        self._lines = collections.OrderedDict()
+        self.cache_lines = cache_lines
+        self._consumer = None
+
+    def close(self):
+        self._mmap.close()
+
+    def source_content_for(self, source):
+        """ See SourceMapConsumer.source_content_for """
+        return _source_content(self._sources_content, self._source_indexes.get(source))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _decode(self, segment):
+        try:
+            return self._segments[segment]
+        except KeyError:
+            if len(self._segments) >= self.SEGMENT_CACHE:
+                self._segments.clear()
+            values = self._segments[segment] = _decode_segment(segment)
+            return values
+
+    def _line_end(self, offset):
+        end = self._mmap.find(b';', offset, self._mappings_end)
+        return self._mappings_end if end < 0 else end
+
+    def _skip_line(self, offset, state):
+        """ Add the deltas of the line at offset to state; return the next line's offset """
+        end = self._line_end(offset)
+        if end > offset:
+            decode = self._decode
+            for segment in self._mmap[offset:end].decode('ascii').split(','):
+                if segment:
+                    values = decode(segment)
+                    if len(values) > 1:
+                        state[0] += values[1]
+                        state[1] += values[2]
+                        state[2] += values[3]
+                        if len(values) == 5:
+                            state[3] += values[4]
+        return end + 1
+
+    def _checkpoint(self, index):
+        """ (offset, state) of checkpoint index, or None past the end of the mappings """
+        offsets = self._checkpoint_offsets
+        while index >= len(offsets) and not self._indexed_to_end:
+            offset = offsets[-1]
+            state = list(self._checkpoint_states[-4:])
+            for _ in range(self.CHECKPOINT_LINES):
+                if offset > self._mappings_end:
+                    break
+                offset = self._skip_line(offset, state)
+            if offset > self._mappings_end:
+                self._indexed_to_end = True
+                break
+            offsets.append(offset)
+            self._checkpoint_states.extend(state)
+        if index >= len(offsets):
+            return None
+        return offsets[index], list(self._checkpoint_states[4 * index:4 * index + 4])
+
+    def _line(self, line):
+        """ The decoded mappings of a generated line (1-based): parallel arrays of
+            generated columns, sources, original lines, original columns and names
+        """
+        lines = self._lines
+        try:
+            lines.move_to_end(line)
+            return lines[line]
+        except KeyError:
+            pass
+        columns = tuple(array('i') for _ in range(5))
+        checkpoint = self._checkpoint((line - 1) // self.CHECKPOINT_LINES)
+        if checkpoint is not None:
+            offset, state = checkpoint
+            for _ in range((line - 1) % self.CHECKPOINT_LINES):
+                if offset > self._mappings_end:
+                    break
+                offset = self._skip_line(offset, state)
+            if offset <= self._mappings_end:
+                self._decode_line(offset, state, columns)
+        lines[line] = columns
+        if len(lines) > self.cache_lines:
+            lines.popitem(last=False)
+        return columns
+
+    def _decode_line(self, offset, state, columns):
+        generated_columns, sources, original_lines, original_columns, names = columns
+        end = self._line_end(offset)
+        if end == offset:
+            return
+        generated_column = 0
+        for segment in self._mmap[offset:end].decode('ascii').split(','):
+            if not segment:
+                continue
+            values = self._decode(segment)
+            generated_column += values[0]
+            generated_columns.append(generated_column)
+            if len(values) == 1:
+                sources.append(-1)
+                original_lines.append(0)
+                original_columns.append(0)
+                names.append(-1)
+                continue
+            state[0] += values[1]
+            state[1] += values[2]
+            state[2] += values[3]
+            sources.append(state[0])
+            original_lines.append(state[1] + 1)
+            original_columns.append(state[2])
+            if len(values) == 5:
+                state[3] += values[4]
+                names.append(state[3])
+            else:
+                names.append(-1)
+        if any(a > b for a, b in zip(generated_columns, generated_columns[1:])):
+            order = sorted(range(len(generated_columns)), key=generated_columns.__getitem__)
+            for column in columns:
+                column[:] = array('i', [column[i] for i in order])
+
+    def _find_original(self, line, column):
+        """ (source index, line, column, name index) for a generated position, or None """
+        if line < 1:
+            return None
+        generated_columns, sources, original_lines, original_columns, names = self._line(line)
+        idx = bisect.bisect_right(generated_columns, column) - 1
+        if idx < 0 or sources[idx] < 0:
+            return None
+        return sources[idx], original_lines[idx], original_columns[idx], names[idx]
+
+    def original_position_for(self, line, column):
+        """ See SourceMapConsumer.original_position_for """
+        found = self._find_original(line, column)
+        if found is None:
+            return {'source': None, 'line': None, 'column': None, 'name': None}
+        src_idx, original_line, original_column, name_idx = found
+        return {
+            'source': self.sources[src_idx],
+            'line': original_line,
+            'column': original_column,
+            'name': self.names[name_idx] if name_idx >= 0 else None,
+        }
+
+    def lookup_many(self, positions):
+        """ original_position_for for each (line, column) in positions, returned as a list """
+        return [self.original_position_for(line, column) for line, column in positions]
+
+    def generated_positions_for(self, source, line, column=None):
+        """ See SourceMapConsumer.generated_positions_for. This needs a reverse
+            index of every mapping, so the first call decodes the whole map.
+        """
+        if self._consumer is None:
+            self._consumer = SourceMapConsumer({
+                'version': 3, 'sources': self.sources, 'names': self.names,
+                'mappings': self._mmap[self._mappings_start:self._mappings_end].decode('ascii')})
+        return self._consumer.generated_positions_for(source, line, column)
+
+
+# A binary sourcemap holds what SourceMapGenerator does, laid out so loading it
+# needs no parsing or VLQ decoding. Integers are little-endian:
+#   header   BINARY_MAP_HEADER: magic, version, the number of sources, names,
+#            mappings and line starts, and the byte lengths of strings and extra
+#   strings  the sources then the names, each a uint32 byte length and UTF-8
+#   extra    the other members of the map (file, sourceRoot, ...) as a JSON object
+#   columns  int32 generated lines, generated columns, source indexes, original
+#            lines, original columns and name indexes (one entry per mapping, in
+#            generated order), then the line starts (see _line_starts)
+# strings and extra are padded with NULs to a multiple of 4 bytes so the columns are aligned.
+BINARY_MAP_MAGIC = b'\x89SMAPBIN'
+BINARY_MAP_VERSION = 1
+BINARY_MAP_HEADER = struct.Struct('<8s7I')
+_UINT32 = struct.Struct('<I')
+_BINARY_MAP_COLUMNS = ('_generated_lines', '_generated_columns', '_original_sources',
+                       '_original_lines', '_original_columns', '_original_names')
+_JSON_MAP_MEMBERS = ('version', 'sources', 'names', 'mappings')
+
+
+def _padding(length):
+    return b'\0' * (-length % 4)
+
+
+def _write_binary_map(sources, names, columns, line_starts, extra=None):
+    strings = []
+    for string in sources + names:
+        string = string.encode('utf-8')
+        strings.append(_UINT32.pack(len(string)))
+        strings.append(string)
+    strings = b''.join(strings)
+    if extra and 'sourcesContent' in extra:
+        # last, readers stop at it (see _json_map)
+        extra = dict(extra)
+        extra['sourcesContent'] = extra.pop('sourcesContent')
+    extra = json.dumps(extra).encode('utf-8') if extra else b''
+    parts = [BINARY_MAP_HEADER.pack(BINARY_MAP_MAGIC, BINARY_MAP_VERSION, len(sources), len(names),
+                                    len(columns[0]), len(line_starts), len(strings), len(extra)),
+             strings, _padding(len(strings)), extra, _padding(len(extra))]
+    for column in columns + [line_starts]:
+        if sys.byteorder == 'big':
+            column = array('i', column)
+            column.byteswap()
+        parts.append(column.tobytes())
+    return b''.join(parts)
+
+
+def _read_binary_map(data):
+    """ (sources, names, extra dict, columns) of a binary sourcemap. The columns
+        (the six mapping columns and the line starts) are int32 memoryviews of data,
+        except on big-endian machines where they are byte-swapped copies.
+    """
+    if data[:len(BINARY_MAP_MAGIC)] != BINARY_MAP_MAGIC:
+        raise ValueError('Not a binary sourcemap')
+    (_, version, source_count, name_count, mapping_count, line_start_count,
+     strings_length, extra_length) = BINARY_MAP_HEADER.unpack_from(data)
+    if version != BINARY_MAP_VERSION:
+        raise ValueError('Unsupported binary sourcemap version: %r' % version)
+    view = memoryview(data)
+    pos = BINARY_MAP_HEADER.size
+    strings = []
+    for _ in range(source_count + name_count):
+        length, = _UINT32.unpack_from(data, pos)
+        pos += _UINT32.size
+        strings.append(str(view[pos:pos + length], 'utf-8'))
+        pos += length
+    pos = BINARY_MAP_HEADER.size + strings_length + len(_padding(strings_length))
+    # (its sourcesContent stays encoded until asked for)
+    extra = _json_map(bytes(view[pos:pos + extra_length]), required=()) if extra_length else {}
+    pos += extra_length + len(_padding(extra_length))
+
+    itemsize = array('i').itemsize
+    if pos + itemsize * (6 * mapping_count + line_start_count) > len(view):
+        raise ValueError('Truncated binary sourcemap')
+    columns = []
+    for count in (mapping_count,) * 6 + (line_start_count,):
+        column = view[pos:pos + itemsize * count].cast('i')
+        if sys.byteorder == 'big':
+            column = array('i', column)
+            column.byteswap()
+        columns.append(column)
+        pos += itemsize * count
+    return strings[:source_count], strings[source_count:], extra, columns
+
+
+def json_map_to_binary(source_map):
+    """ Convert a v3 sourcemap (a dict or JSON) to a binary sourcemap. Members other
+        than the mappings, sources and names are kept as they are.
+    """
+    if not isinstance(source_map, dict):
+        source_map = json.loads(source_map)
+    if 'sections' in source_map:
+        raise ValueError('Index maps cannot be converted to binary sourcemaps')
+    consumer = SourceMapConsumer(source_map)
+    extra = dict((key, value) for key, value in source_map.items() if key not in _JSON_MAP_MEMBERS)
+    return _write_binary_map(consumer.sources, consumer.names,
+                             [getattr(consumer, attr) for attr in _BINARY_MAP_COLUMNS],
+                             consumer._line_starts, extra)
+
+
+def binary_map_to_json(data):
+    """ Convert a binary sourcemap back to a v3 sourcemap (JSON) """
+    sources, names, extra, columns = _read_binary_map(data)
+    contents = extra.pop('sourcesContent', None)
+    obj = {'version': 3}
+    obj.update(extra)
+    obj['sources'] = sources
+    if names or contents is not None:
+        obj['names'] = names
+    obj['mappings'] = SourceMapGenerator._from_columns(sources, names, columns).serializeMappings()
+    if contents is not None:
+        # last, like to_json writes it
+        obj['sourcesContent'] = list(contents)
+    return json.dumps(obj)
+
+
+# From https://github.com/mozilla/source-map/blob/master/lib/util.js#L385
+def strcmp(aStr1, aStr2):
+  if (aStr1 == aStr2):
+    return 0
+  if (aStr1 > aStr2):
+    return 1
+  return -1
+def util_compareByGeneratedPositionsInflated(mappingA, mappingB):
+  """
+   * Comparator between two mappings with inflated source and name strings where
+   * the generated positions are compared.
+  """
+  cmp = mappingA.generatedLine - mappingB.generatedLine
+  if (cmp != 0):
+    return cmp
+
+  cmp = mappingA.generatedColumn - mappingB.generatedColumn
+  if (cmp != 0):
+    return cmp
+
+  cmp = strcmp(mappingA.source, mappingB.source)
+  if (cmp != 0):
+    return cmp
+
+  cmp = mappingA.originalLine - mappingB.originalLine
+  if (cmp != 0):
+    return cmp
+
+  cmp = mappingA.originalColumn - mappingB.originalColumn
+  if (cmp != 0):
+    return cmp
+
+  return strcmp(mappingA.name, mappingB.name)
+
+
+@contextlib.contextmanager
+def _get_writer(file_or_filename, encoding):
+    # returns text write method and release all resources after using
+    try:
+        write = file_or_filename.write
+    except AttributeError:
+        # file_or_filename is a file name
+        if encoding == "unicode":
+            file = open(file_or_filename, "w")
+        else:
+            file = open(file_or_filename, "w", encoding=encoding,
+                        errors="xmlcharrefreplace")
+        with file:
+            yield file.write
+    else:
+        # file_or_filename is a file-like object
+        # encoding determines if it is a text or binary writer
+        if encoding == "unicode":
+            # use a text writer as is
+            yield write
+        else:
+            # wrap a binary writer with TextIOWrapper
+            with contextlib.ExitStack() as stack:
+                if isinstance(file_or_filename, io.BufferedIOBase):
+                    file = file_or_filename
+                elif isinstance(file_or_filename, io.RawIOBase):
+                    file = io.BufferedWriter(file_or_filename)
+                    # Keep the original file open when the BufferedWriter is
+                    # destroyed
+                    stack.callback(file.detach)
+                else:
+                    # This is to handle passed objects that aren't in the
+                    # IOBase hierarchy, but just have a write method
+                    file = io.BufferedIOBase()
+                    file.writable = lambda: True
+                    file.write = write
+                    try:
+                        # TextIOWrapper uses this methods to determine
+                        # if BOM (for UTF-16, etc) should be added
+                        file.seekable = file_or_filename.seekable
+                        file.tell = file_or_filename.tell
+                    except AttributeError:
+                        pass
+                file = io.TextIOWrapper(file,
+                                        encoding=encoding,
+                                        errors="xmlcharrefreplace",
+                                        newline="\n")
+                # Keep the original file open when the TextIOWrapper is
+                # destroyed
+                stack.callback(file.detach)
+                yield file.write
+
+def _escape_cdata(text):
     # escape character data
     try:
         # it's worth avoiding do-nothing calls for strings that are
@@ -416,6 +2433,34 @@ def _escape_attrib(text):
     except (TypeError, AttributeError):
         _raise_serialization_error(text)
 
+def _add_qname(qname, qnames, namespaces, default_namespace=None):
+    # calculate serialized qname representation
+    try:
+        if qname[:1] == "{":
+            uri, tag = qname[1:].rsplit("}", 1)
+            prefix = namespaces.get(uri)
+            if prefix is None:
+                prefix = _namespace_map.get(uri)
+                if prefix is None:
+                    prefix = "ns%d" % len(namespaces)
+                if prefix != "xml":
+                    namespaces[uri] = prefix
+            if prefix:
+                qnames[qname] = "%s:%s" % (prefix, tag)
+            else:
+                qnames[qname] = tag # default element
+        else:
+            if default_namespace:
+                # FIXME: can this be handled in XML 1.0?
+                raise ValueError(
+                    "cannot use non-qualified names with "
+                    "default_namespace option"
+                    )
+            qnames[qname] = qname
+    except TypeError:
+        _raise_serialization_error(qname)
+
+
 def _namespaces(elem, default_namespace=None):
     # identify namespaces used in this tree
 
@@ -428,31 +2473,7 @@ def _namespaces(elem, default_namespace=None):
         namespaces[default_namespace] = ""
 
     def add_qname(qname):
-        # calculate serialized qname representation
-        try:
-            if qname[:1] == "{":
-                uri, tag = qname[1:].rsplit("}", 1)
-                prefix = namespaces.get(uri)
-                if prefix is None:
-                    prefix = _namespace_map.get(uri)
-                    if prefix is None:
-                        prefix = "ns%d" % len(namespaces)
-                    if prefix != "xml":
-                        namespaces[uri] = prefix
-                if prefix:
-                    qnames[qname] = "%s:%s" % (prefix, tag)
-                else:
-                    qnames[qname] = tag # default element
-            else:
-                if default_namespace:
-                    # FIXME: can this be handled in XML 1.0?
-                    raise ValueError(
-                        "cannot use non-qualified names with "
-                        "default_namespace option"
-                        )
-                qnames[qname] = qname
-        except TypeError:
-            _raise_serialization_error(qname)
+        _add_qname(qname, qnames, namespaces, default_namespace)
 
     # populate qname and namespaces table
     for elem in elem.iter():
@@ -478,27 +2499,103 @@ def _namespaces(elem, default_namespace=None):
     return qnames, namespaces
 
 
-def writeXML(input_filename, smap, root_node, file_or_filename,
-          encoding=None,
-          xml_declaration=None,
-          default_namespace=None,
-          method=None,
-          short_empty_elements=True):
-    """Write element tree to a file as XML.
-    Arguments:
-      *file_or_filename* -- file name or a file object opened for writing
-      *encoding* -- the output encoding (default: US-ASCII)
-      *xml_declaration* -- bool indicating if an XML declaration should be
-                           added to the output. If None, an XML declaration
-                           is added if encoding IS NOT either of:
-                           US-ASCII, UTF-8, or Unicode
-      *default_namespace* -- sets the default XML namespace (for "xmlns")
-      *method* -- either "xml" (default), "html, "text", or "c14n"
+class _QNames(dict):
+    """ The qnames table of _namespaces for one namespace configuration
+        (uri -> prefix), filled in as the serializer looks names up.
+    """
+    # Stop remembering names past this many; generated names would grow it forever
+    MAX_NAMES = 65536
+
+    def __init__(self, namespaces):
+        super(_QNames, self).__init__({None: None})
+        self.namespaces = namespaces
+
+    def __missing__(self, qname):
+        try:
+            if qname[:1] == "{":
+                uri, tag = qname[1:].rsplit("}", 1)
+                prefix = self.namespaces.get(uri)
+                if prefix is None:
+                    prefix = _namespace_map.get(uri)
+                    if prefix != "xml":
+                        raise ValueError("namespace %r is not declared, was the tree "
+                                         "modified after it was parsed?" % uri)
+                name = "%s:%s" % (prefix, tag) if prefix else tag
+            else:
+                name = qname
+        except TypeError:
+            _raise_serialization_error(qname)
+        if len(self) < self.MAX_NAMES:
+            self[qname] = name
+        return name
+
+
+# Namespace configurations _cached_namespaces keeps the qnames of
+QNAME_CACHE_SIZE = 64
+_qname_caches = collections.OrderedDict()
+_qname_caches_lock = threading.Lock()
+
+
+def _cached_namespaces(elem, default_namespace=None):
+    """ _namespaces without walking the tree, for a tree from LineNumberingParser that
+        was not modified since: the parser recorded the namespace uris in the order
+        _namespaces would meet them. The qnames come from a process-wide cache,
+        one per namespace configuration, which resolves names on first use.
+        Other trees (and default_namespace) go through _namespaces.
+    """
+    uris = getattr(elem, '_namespace_uris', None)
+    if uris is None or default_namespace:
+        return _namespaces(elem, default_namespace)
+    namespaces = {}
+    for uri in uris:
+        _add_qname("{%s}" % uri, {}, namespaces)
+    key = tuple(namespaces.items())
+    with _qname_caches_lock:
+        try:
+            qnames = _qname_caches[key]
+            _qname_caches.move_to_end(key)
+        except KeyError:
+            qnames = _qname_caches[key] = _QNames(dict(namespaces))
+            if len(_qname_caches) > QNAME_CACHE_SIZE:
+                _qname_caches.popitem(last=False)
+    return qnames, namespaces
+
+
+def writeXML(input_filename, smap, root_node, file_or_filename,
+          encoding=None,
+          xml_declaration=None,
+          default_namespace=None,
+          method=None,
+          short_empty_elements=True,
+          source=None,
+          fragments=None,
+          attribute_names=False,
+          simplify='none'):
+    """Write element tree to a file as XML.
+    Arguments:
+      *file_or_filename* -- file name or a file object opened for writing
+      *encoding* -- the output encoding (default: US-ASCII)
+      *xml_declaration* -- bool indicating if an XML declaration should be
+                           added to the output. If None, an XML declaration
+                           is added if encoding IS NOT either of:
+                           US-ASCII, UTF-8, or Unicode
+      *default_namespace* -- sets the default XML namespace (for "xmlns")
+      *method* -- either "xml" (default), "html, "text", or "c14n"
       *short_empty_elements* -- controls the formatting of elements
                                 that contain no content. If True (default)
                                 they are emitted as a single self-closed
                                 tag, otherwise they are emitted as a pair
                                 of start/end tags
+      *source* -- the bytes (or str) root_node was parsed from, needed
+                  with *fragments*
+      *fragments* -- a FragmentCache; subtrees whose source bytes did not
+                     change since its previous use are copied from it
+                     instead of serialized again (not with *simplify*)
+      *attribute_names* -- add attribute names to the sourcemap's names,
+                           when root_node was parsed with a granularity of
+                           "attribute" or finer
+      *simplify* -- leave out mappings as they are written, one of
+                    MAP_SIMPLIFICATIONS (default "none")
     """
     method = "xml"
     if not encoding:
@@ -509,6 +2606,7 @@ def writeXML(input_filename, smap, root_node, file_or_filename,
         encoding = "unicode"
     enc_lower = encoding.lower()
     with _get_writer(file_or_filename, enc_lower) as write:
+        out = _mapped_writer(write, smap, smap.add_source(input_filename), simplify)
         if method == "xml" and (xml_declaration or
                 (xml_declaration is None and
                  enc_lower not in ("utf-8", "us-ascii", "unicode"))):
@@ -517,109 +2615,1845 @@ def writeXML(input_filename, smap, root_node, file_or_filename,
                 # Retrieve the default encoding for the xml declaration
                 import locale
                 declared_encoding = locale.getpreferredencoding()
-            write("<?xml version='1.0' encoding='%s'?>\n" % (
+            out.write_unmapped("<?xml version='1.0' encoding='%s'?>\n" % (
                 declared_encoding,))
         if method == "text":
             _serialize_text(write, root_node)
         else:
-            qnames, namespaces = _namespaces(root_node, default_namespace)
-            pos = (1, 0) # Lines are 1-based (but so are maybe columns?)
-            _serialize_xml(input_filename, smap, write, root_node, qnames, namespaces, pos,
-                      short_empty_elements=short_empty_elements)
+            qnames, namespaces = _cached_namespaces(root_node, default_namespace)
+            detailed = getattr(root_node, '_positions', None) is not None
+            add_name = smap.add_name if detailed and attribute_names else None
+            if simplify != 'none':
+                # which mappings are left out depends on the mappings before a
+                # subtree, a fragment would carry that over to another place
+                fragments = None
+            if fragments is not None:
+                fragments.begin(out, smap, source, (tuple(sorted(namespaces.items())),
+                                                    short_empty_elements, detailed,
+                                                    add_name is not None))
+            _serialize_xml(out, root_node, qnames, namespaces,
+                           short_empty_elements=short_empty_elements,
+                           fragments=fragments, detailed=detailed, add_name=add_name)
+            if fragments is not None:
+                fragments.end()
+        out.flush()
 
 
-def _serialize_xml(input_filename, smap, write, elem, qnames, namespaces, pos,
-                   short_empty_elements, **kwargs):
+def _write_attributes(out, attributes, positions, line, column, add_name=None):
+    """ Write serialized (document index, name, value) attributes. With positions
+        (_Positions.attributes) the name and the value each get a mapping to where
+        they were, named after the attribute when add_name is given; otherwise the
+        whole attribute maps to line/column.
+    """
+    write = out.write
+    for i, k, v in attributes:
+        if positions is None or 4 * i >= len(positions):
+            write(" %s=\"%s\"" % (k, v), line, column)
+            continue
+        i *= 4
+        out.write_unmapped(" ")
+        write(k + "=\"", positions[i], positions[i + 1], add_name(k) if add_name else -1)
+        write(v + "\"", positions[i + 2], positions[i + 3])
 
-    def __writer(pos, node, text):
-        (line_num, column_num) = pos
-        # print("SERIALIZE", line_num, column_num)
-        smap.addMapping(Mapping(source=input_filename, generatedLine=line_num, generatedColumn=column_num, originalLine=node._start_line_number, originalColumn=node._start_column_number))
 
-        write(text)
-        pos = adjust_pos(line_num, column_num, text)
-        return pos
+def _write_text(out, text, positions, line, column):
+    """ Write serialized text. With positions (_Positions.text/tail) it maps to where
+        the text run was, and each token that was found in the source gets its own
+        mapping; otherwise all of it maps to line/column.
+    """
+    if positions is None:
+        out.write(text, line, column)
+        return
+    line = positions[0]
+    column = positions[1]
+    count = len(positions)
+    if count == 2:
+        out.write(text, line, column)
+        return
+    write = out.write
+    start = 0
+    i = 2
+    for token in _TOKEN_RE.finditer(text):
+        if i >= count:
+            break
+        token_start = token.start()
+        if token_start > start:
+            write(text[start:token_start], line, column)
+            start = token_start
+        line = positions[i]
+        column = positions[i + 1]
+        i += 2
+    write(text[start:], line, column)
 
-    def __writer_end(pos, node, text):
-        """ used for close tags """
-        (line_num, column_num) = pos
-        # print("SERIALIZE_END", line_num, column_num)
-        smap.addMapping(Mapping(source=input_filename, generatedLine=line_num, generatedColumn=column_num, originalLine=node._end_line_number, originalColumn=node._end_column_number))
 
-        write(text)
-        pos = adjust_pos(line_num, column_num, text)
-        return pos
+def _serialize_xml(out, elem, qnames, namespaces,
+                   short_empty_elements, fragments=None, detailed=False, add_name=None,
+                   **kwargs):
+    # Walks the tree with an explicit stack instead of recursing so deeply
+    # nested documents do not hit the recursion limit.
+    # fragments is a FragmentCache (already begun) to reuse/record subtrees with.
+    # detailed: the tree has _Positions (a granularity finer than "element").
+    # add_name: SourceMapGenerator.add_name to name attribute mappings with.
+    write = out.write
+    root = elem
+    # serialized ' key="value"' strings; the same attributes recur all over a document
+    attributes = {}
+    positions = None
+    # Elements still to write and (element, serialized tag, fragment record) tuples
+    # still to close, the next one to handle is at the end.
+    stack = [elem]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        elem = pop()
+        if type(elem) is tuple:
+            elem, tag, fragment = elem
+            if tag is not None:
+                write("</" + tag + ">", elem._end_line_number, elem._end_column_number)
+            if fragment is not None:
+                fragments.finish(fragment)
+            if elem.tail:
+                if detailed:
+                    _write_text(out, _escape_cdata(elem.tail), elem._positions.tail,
+                                elem._start_line_number, elem._start_column_number)
+                else:
+                    write(_escape_cdata(elem.tail), elem._start_line_number, elem._start_column_number)
+            continue
 
-    tag = elem.tag
-    text = elem.text
-    if tag is Comment:
-        pos = __writer(pos, elem, "<!--%s-->" % text)
-    elif tag is ProcessingInstruction:
-        pos = __writer(pos, elem, "<?%s?>" % text)
-    else:
-        tag = qnames[tag]
-        if tag is None:
-            if text:
-                pos = __writer(pos, elem, _escape_cdata(text))
-            for e in elem:
-                _serialize_xml(input_filename, smap, write, e, qnames, None, pos,
-                               short_empty_elements=short_empty_elements)
+        line = elem._start_line_number
+        column = elem._start_column_number
+        tag = elem.tag
+        text = elem.text
+        if detailed:
+            positions = elem._positions
+        fragment = None
+        if fragments is not None and elem is not root and tag.__class__ is str:
+            key = fragments.key(elem)
+            if key is not None:
+                if fragments.reuse(key, elem):
+                    if elem.tail:
+                        _write_text(out, _escape_cdata(elem.tail),
+                                    positions.tail if detailed else None, line, column)
+                    continue
+                fragment = fragments.record(key, elem)
+        if tag is Comment:
+            write("<!--%s-->" % text, line, column)
+        elif tag is ProcessingInstruction:
+            write("<?%s?>" % text, line, column)
         else:
-            pos = __writer(pos, elem, "<" + tag)
-            items = list(elem.items())
-            if items or namespaces:
-                if namespaces:
-                    for v, k in sorted(namespaces.items(),
-                                       key=lambda x: x[1]):  # sort on prefix
-                        if k:
-                            k = ":" + k
-                        pos = __writer(pos, elem, " xmlns%s=\"%s\"" % (
-                            k,
-                            _escape_attrib(v)
-                            ))
-                for k, v in sorted(items):  # lexical order
-                    if isinstance(k, QName):
-                        k = k.text
-                    if isinstance(v, QName):
-                        v = qnames[v.text]
-                    else:
-                        v = _escape_attrib(v)
-                    pos = __writer(pos, elem, " %s=\"%s\"" % (qnames[k], v))
+            tag = qnames[tag]
+            if tag is None:
+                if text:
+                    _write_text(out, _escape_cdata(text),
+                                positions.text if detailed else None, line, column)
+                namespaces = None
+                push((elem, None, fragment))
+                stack.extend(reversed(elem))
+                continue
+            write("<" + tag, line, column)
+            if namespaces:
+                for v, k in sorted(namespaces.items(),
+                                   key=lambda x: x[1]):  # sort on prefix
+                    if k:
+                        k = ":" + k
+                    write(" xmlns%s=\"%s\"" % (
+                        k,
+                        _escape_attrib(v)
+                        ), line, column)
+                # only the root element declares them
+                namespaces = None
+            items = elem.items()
+            if items:
+                if detailed:
+                    serialized = []
+                    for i, (k, v) in sorted(enumerate(items), key=lambda x: x[1]):  # lexical order
+                        if isinstance(k, QName):
+                            k = k.text
+                        if isinstance(v, QName):
+                            v = qnames[v.text]
+                        else:
+                            v = _escape_attrib(v)
+                        serialized.append((i, qnames[k], v))
+                    _write_attributes(out, serialized, positions.attributes, line, column, add_name)
+                else:
+                    for item in sorted(items):  # lexical order
+                        try:
+                            attribute = attributes[item]
+                        except KeyError:
+                            k, v = item
+                            if isinstance(k, QName):
+                                k = k.text
+                            if isinstance(v, QName):
+                                v = qnames[v.text]
+                            else:
+                                v = _escape_attrib(v)
+                            attribute = attributes[item] = " %s=\"%s\"" % (qnames[k], v)
+                        write(attribute, line, column)
             if text or len(elem) or not short_empty_elements:
-                pos = __writer(pos, elem, ">")
+                write(">", line, column)
                 if text:
-                    pos = __writer(pos, elem, _escape_cdata(text))
-                for e in elem:
-                    _serialize_xml(input_filename, smap, write, e, qnames, None, pos,
-                                   short_empty_elements=short_empty_elements)
-                pos = __writer_end(pos, elem, "</" + tag + ">")
+                    if detailed:
+                        _write_text(out, _escape_cdata(text), positions.text, line, column)
+                    else:
+                        write(_escape_cdata(text), line, column)
+                push((elem, tag, fragment))
+                stack.extend(reversed(elem))
+                continue
+            write(" />", elem._end_line_number, elem._end_column_number)
+        if fragment is not None:
+            fragments.finish(fragment)
+        if elem.tail:
+            if detailed:
+                _write_text(out, _escape_cdata(elem.tail), positions.tail, line, column)
+            else:
+                write(_escape_cdata(elem.tail), line, column)
+
+
+class _Fragment(object):
+    """ A serialized subtree: its text and mappings relative to where it starts.
+        names is None, or the name (or None) of each mapping.
+        Generated/original lines are relative to the first line; columns are
+        relative to the first column on the first line only, so the fragment
+        can be written at any position.
+    """
+    __slots__ = ('text', 'generated_lines', 'generated_columns', 'original_lines',
+                 'original_columns', 'names', 'children')
+
+    def shifted(self, gen_line, gen_col, orig_line, orig_col):
+        """ Return the mapping columns for a copy starting at gen_line:gen_col,
+            from a subtree starting at orig_line:orig_col of the source
+        """
+        gen_lines = self.generated_lines
+        gen_cols = array('i', self.generated_columns)
+        # the mappings are in generated order, so the first line is a prefix
+        for i in range(bisect.bisect_left(gen_lines, 1)):
+            gen_cols[i] += gen_col
+        orig_cols = array('i', [c + orig_col if l == 0 else c
+                                for l, c in zip(self.original_lines, self.original_columns)])
+        return (array('i', [l + gen_line for l in gen_lines]), gen_cols,
+                array('i', [l + orig_line for l in self.original_lines]), orig_cols)
+
+
+class _FragmentRecord(object):
+    """ A fragment being serialized by _serialize_xml """
+    __slots__ = ('key', 'part', 'row', 'line', 'column', 'original_line', 'original_column',
+                 'children')
+
+
+class FragmentCache(object):
+    """ Serialized subtrees of the previous writeXML call, for incremental conversion.
+
+        A subtree is identified by a hash of the source bytes it was parsed from
+        (_start_byte_index to _end_byte_index). When a later call meets a subtree
+        with the same bytes, its text and mappings are copied (shifted to the new
+        generated and original positions) instead of serialized again. Only the
+        fragments used by the latest call are kept.
+
+        The trees must come from LineNumberingParser and must not have been modified
+        since, and `source` must be the bytes they were parsed from (str is encoded
+        as UTF-8, like expat does when fed a str).
+    """
+    # Subtrees smaller than this are cheaper to serialize than to hash and copy
+    MIN_BYTES = 256
+    # Do not fingerprint subtrees nested deeper than this inside other fingerprinted
+    # subtrees; every level hashes the bytes of the levels below it again.
+    MAX_NESTING = 8
+
+    def __init__(self, min_bytes=MIN_BYTES, max_nesting=MAX_NESTING):
+        self.min_bytes = min_bytes
+        self.max_nesting = max_nesting
+        self.hits = 0
+        self.misses = 0
+        self._fragments = {}
+        self._settings = None
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def begin(self, out, smap, source, settings):
+        """ Start a writeXML call: collect out's text so fragments can be cut from it.
+            settings holds everything besides the source that changes the output
+            (namespaces, short_empty_elements, ...).
+        """
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        if settings != self._settings:
+            # the same source would come out differently
+            self._fragments = {}
+            self._settings = settings
+        self._source = memoryview(source)
+        self._out = out
+        self._smap = smap
+        self._write = out._write
+        self._parts = []
+        out._write = self._parts.append
+        self._next = {}
+        self._open = []
+
+    def end(self):
+        """ Finish the writeXML call: write the collected text, keep only the fragments it used """
+        out = self._out
+        out._write = self._write
+        out._write("".join(self._parts))
+        self._fragments = self._next
+        self._source = self._out = self._smap = self._write = self._parts = self._next = None
+
+    def key(self, elem):
+        """ The fingerprint of elem's subtree, or None if it is not worth caching """
+        start = elem._start_byte_index
+        end = elem._end_byte_index
+        if end - start < self.min_bytes or len(self._open) >= self.max_nesting:
+            return None
+        return hashlib.blake2b(self._source[start:end], digest_size=16).digest()
+
+    def _keep(self, key, fragment):
+        self._next[key] = fragment
+        if self._open:
+            self._open[-1].children.append(key)
+
+    def reuse(self, key, elem):
+        """ Write the cached fragment for key, if any, in place of elem's subtree (not its tail) """
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            return False
+        self.hits += 1
+        out = self._out
+        out.flush()
+        gen_lines, gen_cols, orig_lines, orig_cols = fragment.shifted(
+            out.line, out.column, elem._start_line_number, elem._start_column_number)
+        names = None
+        if fragment.names is not None:
+            add_name = self._smap.add_name
+            names = [add_name(name) if name is not None else -1 for name in fragment.names]
+        self._smap.extend_raw(gen_lines, gen_cols, out.source_idx, orig_lines, orig_cols, names)
+        out.write_unmapped(fragment.text)
+        self._keep(key, fragment)
+        # the fragments inside it stay reusable too
+        pending = list(fragment.children)
+        while pending:
+            child = pending.pop()
+            if child in self._fragments and child not in self._next:
+                fragment = self._next[child] = self._fragments[child]
+                pending.extend(fragment.children)
+        return True
+
+    def record(self, key, elem):
+        """ Start recording elem's subtree as the fragment for key; see finish() """
+        self.misses += 1
+        out = self._out
+        out.flush()
+        record = _FragmentRecord()
+        record.key = key
+        record.part = len(self._parts)
+        record.row = len(self._smap)
+        record.line = out.line
+        record.column = out.column
+        record.original_line = elem._start_line_number
+        record.original_column = elem._start_column_number
+        record.children = []
+        self._open.append(record)
+        return record
+
+    def finish(self, record):
+        """ Store the fragment written since record() (before the element's tail) """
+        self._open.pop()
+        self._out.flush()
+        parts = self._parts
+        text = "".join(parts[record.part:])
+        # join once per level: the enclosing fragment reuses this string
+        del parts[record.part:]
+        parts.append(text)
+
+        smap = self._smap
+        row = record.row
+        line = record.line
+        column = record.column
+        gen_lines = array('i', [l - line for l in smap._generated_lines[row:]])
+        gen_cols = smap._generated_columns[row:]
+        for i in range(bisect.bisect_left(gen_lines, 1)):
+            gen_cols[i] -= column
+        line = record.original_line
+        column = record.original_column
+        orig_cols = array('i', [c - column if l == line else c
+                                for l, c in zip(smap._original_lines[row:],
+                                                smap._original_columns[row:])])
+
+        fragment = _Fragment()
+        fragment.text = text
+        fragment.generated_lines = gen_lines
+        fragment.generated_columns = gen_cols
+        fragment.original_lines = array('i', [l - line for l in smap._original_lines[row:]])
+        fragment.original_columns = orig_cols
+        fragment.names = None
+        names = smap._original_names[row:]
+        if names and max(names) >= 0:
+            fragment.names = [smap._names[name] if name >= 0 else None for name in names]
+        fragment.children = record.children
+        self._keep(record.key, fragment)
+
+
+class _EventTreeBuilder(ET.TreeBuilder):
+    """ TreeBuilder that also records ("start", elem) and ("end", elem) events """
+    def __init__(self, events):
+        super(_EventTreeBuilder, self).__init__(element_factory=PositionedElement)
+        self._events = events
+
+    def start(self, tag, attrs):
+        element = super(_EventTreeBuilder, self).start(tag, attrs)
+        self._events.append(("start", element))
+        return element
+
+    def end(self, tag):
+        element = super(_EventTreeBuilder, self).end(tag)
+        self._events.append(("end", element))
+        return element
+
+
+class _StreamFrame(object):
+    """ An element that has been started but not ended yet """
+    __slots__ = ('elem', 'tag', 'opened', 'last', 'declared')
+
+    def __init__(self, elem, tag, declared):
+        self.elem = elem
+        self.tag = tag  # serialized tag name
+        self.opened = False  # whether ">" and the text have been written
+        self.last = None  # last child whose tail has not been written yet
+        self.declared = declared  # namespace uris declared on this element or an ancestor
+
+
+class _StreamingSerializer(object):
+    """ Serialize elements as the parser completes them instead of walking a finished tree.
+
+        Writes the same fragments (and mappings) as _serialize_xml. A start tag is
+        only finished once we know whether the element has content, and text/tails
+        are written once the next element starts or the parent ends, because that
+        is when TreeBuilder has filled them in. Written elements are removed from
+        their parent so memory is bounded by the depth of the document.
+
+        Namespace declarations are written on the first element that uses them
+        (the tree serializer declares every namespace on the root element).
+    """
+    def __init__(self, input_filename, smap, write, short_empty_elements=True, default_namespace=None,
+                 detailed=False, attribute_names=False, simplify='none'):
+        self.out = _mapped_writer(write, smap, smap.add_source(input_filename), simplify)
+        self.short_empty_elements = short_empty_elements
+        # see _serialize_xml
+        self.detailed = detailed
+        self.add_name = smap.add_name if detailed and attribute_names else None
+        self.default_namespace = default_namespace
+        self.qnames = {None: None}
+        self.namespaces = {}
+        if default_namespace:
+            self.namespaces[default_namespace] = ""
+        self.stack = []
+
+    def _write(self, node, text):
+        self.out.write(text, node._start_line_number, node._start_column_number)
+
+    def _write_end(self, node, text):
+        """ used for close tags """
+        self.out.write(text, node._end_line_number, node._end_column_number)
+
+    def _qname(self, qname, used_uris):
+        if qname not in self.qnames:
+            _add_qname(qname, self.qnames, self.namespaces, self.default_namespace)
+        if qname[:1] == "{":
+            used_uris.append(qname[1:].rsplit("}", 1)[0])
+        return self.qnames[qname]
+
+    def _open(self, frame):
+        """ The element has content: finish its start tag and write its text """
+        elem = frame.elem
+        self._write(elem, ">")
+        if elem.text:
+            self._write_text(elem, elem.text, 'text')
+        frame.opened = True
+
+    def _write_text(self, node, text, which):
+        """ Write node's text or tail """
+        if self.detailed:
+            _write_text(self.out, _escape_cdata(text), getattr(node._positions, which),
+                        node._start_line_number, node._start_column_number)
+        else:
+            self._write(node, _escape_cdata(text))
+
+    def _finish_child(self, frame):
+        """ Write the tail of the last child and drop the child from the tree """
+        child = frame.last
+        if child.tail:
+            self._write_text(child, child.tail, 'tail')
+        frame.elem.remove(child)
+        frame.last = None
+
+    def start(self, elem):
+        if self.stack:
+            parent = self.stack[-1]
+            if not parent.opened:
+                self._open(parent)
+            if parent.last is not None:
+                self._finish_child(parent)
+            parent.last = elem
+            declared = parent.declared
+        else:
+            declared = frozenset()
+
+        used_uris = []
+        tag = elem.tag
+        if isinstance(tag, QName):
+            tag = tag.text
+        tag = self._qname(tag, used_uris)
+        items = []
+        for i, (k, v) in sorted(enumerate(elem.items()), key=lambda x: x[1]):  # lexical order
+            if isinstance(k, QName):
+                k = k.text
+            if isinstance(v, QName):
+                v = self._qname(v.text, used_uris)
             else:
-                pos = __writer_end(pos, elem, " />")
-    if elem.tail:
-        pos = __writer(pos, elem, _escape_cdata(elem.tail))
+                v = _escape_attrib(v)
+            items.append((i, self._qname(k, used_uris), v))
+
+        new_uris = set(uri for uri in used_uris if uri not in declared and uri in self.namespaces)
+        if self.default_namespace and not self.stack:
+            new_uris.add(self.default_namespace)
+        if new_uris:
+            declared = declared.union(new_uris)
+
+        self._write(elem, "<" + tag)
+        for v, k in sorted(((uri, self.namespaces[uri]) for uri in new_uris),
+                           key=lambda x: x[1]):  # sort on prefix
+            if k:
+                k = ":" + k
+            self._write(elem, " xmlns%s=\"%s\"" % (
+                k,
+                _escape_attrib(v)
+                ))
+        _write_attributes(self.out, items, elem._positions.attributes if self.detailed else None,
+                          elem._start_line_number, elem._start_column_number, self.add_name)
+        self.stack.append(_StreamFrame(elem, tag, declared))
+
+    def end(self, elem):
+        frame = self.stack.pop()
+        if frame.opened:
+            if frame.last is not None:
+                self._finish_child(frame)
+            self._write_end(elem, "</" + frame.tag + ">")
+        elif elem.text or not self.short_empty_elements:
+            self._open(frame)
+            self._write_end(elem, "</" + frame.tag + ">")
+        else:
+            self._write_end(elem, " />")
+        if not self.stack and elem.tail:
+            self._write_text(elem, elem.tail, 'tail')
+
+
+class Profiler(object):
+    """ Per-stage instrumentation of convert_file (main.py --profile).
+
+        For each stage (parse, serialize, ...) it records wall time, bytes written,
+        mappings emitted, the calls made to the instrumented functions and, with
+        memory=True, the peak of Python allocations (tracemalloc, which slows
+        everything down several times). Functions are instrumented by swapping
+        in timed wrappers while the profiler is active, so nothing is measured
+        (or slowed down) otherwise. Their times are inclusive: MappedWriter.flush
+        includes SourceMapGenerator.extend_raw. Only profile one conversion at a time.
+
+            profiler = Profiler()
+            with profiler.activate():
+                convert_file(html_in, html_out, source_map, None, profiler=profiler)
+            profiler.to_json()  # or profiler.to_chrome_trace()
+    """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stages = []
+        # function name -> [calls, seconds]
+        self.functions = {}
+        self.bytes_written = 0
+        self.mappings = 0
+        self._start = time.perf_counter()
+
+    def _instrumented(self):
+        """ (owner, attribute, name, measure) of what activate() wraps. measure
+            returns what a call adds to the bytes/mappings counters (or is None).
+        """
+        module = sys.modules[__name__]
+
+        def text_length(args):
+            self.bytes_written += len(args[1])
+
+        def one_mapping(args):
+            self.mappings += 1
+
+        def mapping_run(args):
+            self.mappings += len(args[1])
+
+        return [
+            (LineNumberingParser, '_start', 'LineNumberingParser._start', None),
+            (LineNumberingParser, '_end', 'LineNumberingParser._end', None),
+            (module, '_namespaces', '_namespaces', None),
+            (module, '_cached_namespaces', '_cached_namespaces', None),
+            (module, '_escape_cdata', '_escape_cdata', None),
+            (module, '_escape_attrib', '_escape_attrib', None),
+            (MappedWriter, 'write', 'MappedWriter.write', text_length),
+            (MappedWriter, 'write_unmapped', 'MappedWriter.write_unmapped', text_length),
+            (MappedWriter, 'flush', 'MappedWriter.flush', None),
+            (SourceMapGenerator, 'add_raw', 'SourceMapGenerator.add_raw', one_mapping),
+            (SourceMapGenerator, 'extend_raw', 'SourceMapGenerator.extend_raw', mapping_run),
+            (SourceMapGenerator, 'apply_source_map', 'SourceMapGenerator.apply_source_map', None),
+            (SourceMapGenerator, 'serializeMappings', 'SourceMapGenerator.serializeMappings', None),
+            (SourceMapGenerator, 'flush_mappings', 'SourceMapGenerator.flush_mappings', None),
+        ]
+
+    def _wrap(self, name, func, measure):
+        stats = self.functions.setdefault(name, [0, 0.0])
+        clock = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            if measure is not None:
+                measure(args)
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats[0] += 1
+                stats[1] += clock() - start
+        return wrapper
+
+    @contextlib.contextmanager
+    def activate(self):
+        """ Instrument the functions (and start tracemalloc) for the duration """
+        originals = []
+        for owner, attribute, name, measure in self._instrumented():
+            func = owner.__dict__[attribute]
+            originals.append((owner, attribute, func))
+            setattr(owner, attribute, self._wrap(name, func, measure))
+        if self.memory:
+            tracemalloc.start()
+        try:
+            yield self
+        finally:
+            if self.memory:
+                tracemalloc.stop()
+            for owner, attribute, func in originals:
+                setattr(owner, attribute, func)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Record what happens inside the with block as stage name """
+        calls = dict((function, stats[0]) for function, stats in self.functions.items())
+        bytes_written = self.bytes_written
+        mappings = self.mappings
+        tracing = self.memory and tracemalloc.is_tracing()
+        if tracing:
+            allocated = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            stage = {
+                'name': name,
+                'start': start - self._start,
+                'seconds': end - start,
+                'bytes_written': self.bytes_written - bytes_written,
+                'mappings': self.mappings - mappings,
+                'calls': dict((function, stats[0] - calls.get(function, 0))
+                              for function, stats in self.functions.items()
+                              if stats[0] != calls.get(function, 0)),
+            }
+            if tracing:
+                stage['peak_bytes'] = tracemalloc.get_traced_memory()[1] - allocated
+            self.stages.append(stage)
+
+    def report(self):
+        """ The stages and the totals per function, as a dict """
+        return {
+            'stages': self.stages,
+            'functions': dict((name, {'calls': calls, 'seconds': seconds})
+                              for name, (calls, seconds) in self.functions.items()),
+            'bytes_written': self.bytes_written,
+            'mappings': self.mappings,
+        }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2)
+
+    def to_chrome_trace(self):
+        """ The stages as a Chrome trace-event file (chrome://tracing, Perfetto) """
+        events = []
+        for stage in self.stages:
+            args = dict((key, value) for key, value in stage.items()
+                        if key not in ('name', 'start', 'seconds'))
+            events.append({'name': stage['name'], 'cat': 'convert', 'ph': 'X',
+                           'ts': stage['start'] * 1e6, 'dur': stage['seconds'] * 1e6,
+                           'pid': os.getpid(), 'tid': 1, 'args': args})
+        report = self.report()
+        del report['stages']
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': report})
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+def _no_stage(name):
+    """ Profiler.stage when there is no profiler """
+    return _NO_STAGE
+
+
+def _convert_file_streaming(html_in, html_out, source_map, source_map_input, chunk_size=64 * 1024,
+                            granularity='element', attribute_names=False, profiler=None,
+                            simplify='none', sources_content=False):
+    """ convert_file without ever holding the whole document or all of its mappings """
+    stage = profiler.stage if profiler is not None else _no_stage
+    smap = SourceMapGenerator()
+    consumer = None
+    if source_map_input is not None:
+        with stage('load source map input'):
+            consumer = SourceMapConsumer.from_file(source_map_input)
+    smap.start_stream((source_map or sys.stdout).write, consumer, html_in.name)
+
+    events = []
+    html_parser = LineNumberingParser(target=_EventTreeBuilder(events), encoding="utf-8",
+                                      granularity=granularity)
+    serializer = _StreamingSerializer(html_in.name, smap, html_out.write,
+                                      detailed=granularity != 'element',
+                                      attribute_names=attribute_names, simplify=simplify)
+    handlers = {"start": serializer.start, "end": serializer.end}
+
+    def drain():
+        for event, elem in events:
+            handlers[event](elem)
+        del events[:]
+        serializer.out.flush()
+        # nothing will be written before the current line anymore
+        smap.flush_mappings(serializer.out.line)
+
+    with stage('parse and serialize'):
+        while True:
+            data = html_in.read(chunk_size)
+            if not data:
+                break
+            html_parser.feed(data)
+            drain()
+        html_parser.close()
+        drain()
+
+    with stage('write sourcemap'):
+        if sources_content:
+            # html_in was not kept, it is read again (if it is a file)
+            smap.add_sources_content(_source_contents, consumer)
+        smap.end_stream()
+        (source_map or sys.stdout).write("\n")
+
+
+def convert_file(html_in, html_out, source_map, source_map_input, stream=False,
+                 index_map_lines=None, granularity='element', attribute_names=False,
+                 profiler=None, debug=False, source_map_format='json', simplify='none',
+                 splice=False, sources_content=False):
+    """ Convert html_in to html_out and write its sourcemap to source_map (stdout
+        if None). With splice the input is copied through verbatim by splice_tree,
+        mapped with granularity "line" or "element". With sources_content the
+        sourcemap embeds the text of its sources, read through the SourceContentCache
+        of the process.
+    """
+    if stream:
+        return _convert_file_streaming(html_in, html_out, source_map, source_map_input,
+                                       granularity=granularity, attribute_names=attribute_names,
+                                       profiler=profiler, simplify=simplify,
+                                       sources_content=sources_content)
+    stage = profiler.stage if profiler is not None else _no_stage
+    contents = _source_contents if sources_content else None
+
+    with stage('parse'):
+        source = None
+        if splice or sources_content:
+            # the exact bytes, to copy or embed them
+            source = getattr(html_in, 'buffer', html_in).read()
+            html_parser = LineNumberingParser(encoding="utf-8",
+                                              granularity='element' if splice else granularity)
+            html_parser.feed(source)
+            root = html_parser.close()
+        else:
+            # html_parser = etree.HTMLParser(encoding="utf-8")
+            html_parser = LineNumberingParser(encoding="utf-8", granularity=granularity)
+            root = ET.parse(html_in, html_parser).getroot()
+            # # html_doc = etree.XML(html_in.read(), html_parser)
+            # oven = Oven(css_in, use_repeatable_ids)
+            # oven.bake(html_doc, last_step)
+
+    consumer = None
+    if source_map_input is not None:
+        with stage('load source map input'):
+            consumer = SourceMapConsumer.from_file(source_map_input)
+    if splice:
+        # nothing is transformed (yet), so nothing is dirty
+        smap = splice_tree(html_in.name, root, source, html_out, consumer=consumer,
+                           granularity=granularity, profiler=profiler,
+                           sources_content=contents)
+    else:
+        smap = convert_tree(html_in.name, root, html_out, consumer, source,
+                            attribute_names=attribute_names, profiler=profiler,
+                            simplify=simplify, sources_content=contents)
+
+    if debug:
+        print("SOURCEMAP_STR", str(smap), file=sys.stderr)
+    with stage('write sourcemap'):
+        if index_map_lines:
+            print(smap.to_index_json(index_map_lines), file=source_map)
+        elif source_map_format == 'binary':
+            source_map = source_map or sys.stdout
+            source_map.flush()
+            getattr(source_map, 'buffer', source_map).write(smap.to_binary())
+        else:
+            print(smap.to_json(), file=source_map)
+
+
+def convert_tree(input_filename, root, html_out, consumer=None, source=None, fragments=None,
+                 attribute_names=False, profiler=None, simplify='none', sources_content=None):
+    """ Serialize a tree parsed by LineNumberingParser and return its SourceMapGenerator.
+        consumer is the SourceMapConsumer (or IndexMapConsumer) of input_filename,
+        if it was itself generated.
+        source and fragments enable incremental serialization, see FragmentCache.
+        attribute_names names attribute mappings after the attribute, see writeXML.
+        profiler is a Profiler to record the stages with.
+        simplify is one of MAP_SIMPLIFICATIONS; the mappings that collapse
+        onto the same position through consumer are dropped too.
+        sources_content is a SourceContentCache to embed the text of the sources
+        with; source, when given, is used as the text of input_filename.
+    """
+    stage = profiler.stage if profiler is not None else _no_stage
+    smap = SourceMapGenerator()
+
+    with stage('serialize'):
+        # serialize out HTML
+        # print(etree.tostring(html_doc, method="html"), file=html_out)
+        writeXML(input_filename, smap, root, html_out, source=source, fragments=fragments,
+                 attribute_names=attribute_names, simplify=simplify)
+
+    if consumer is not None:
+        with stage('apply source map input'):
+            # the input was itself generated; point the mappings at its sources instead
+            smap.apply_source_map(consumer, input_filename)
+            if simplify != 'none':
+                smap.simplify()
+    if sources_content is not None:
+        with stage('embed sources'):
+            _embed_sources(smap, sources_content, input_filename, source, consumer)
+    return smap
 
 
+def _embed_sources(smap, contents, input_filename, source=None, consumer=None):
+    """ Embed the text of the sources of smap, taking that of input_filename from
+        source (bytes or str) when given instead of reading it
+    """
+    if source is not None and input_filename in smap._source_indexes:
+        smap.set_source_content(input_filename, contents.add(source))
+    smap.add_sources_content(contents, consumer)
+
+
+def _self_closing(source, elem):
+    """ Whether elem was written as <tag ... /> in source """
+    match = _START_TAG_RE.match(source, elem._start_byte_index)
+    return match is not None and match.end() == elem._end_byte_index and match.group(2) == b'/'
+
+
+def _markup_end(source, elem):
+    """ The byte index and original line, column right after elem's markup in source
+        (its end tag, or the tag itself if it was self-closing); its tail starts there
+    """
+    end = elem._end_byte_index
+    line = elem._end_line_number
+    column = elem._end_column_number
+    if _self_closing(source, elem):
+        # expat reports the end of <tag/> after it
+        return end, line, column
+    stop = source.index(b'>', end) + 1
+    text = str(source[end:stop], 'utf-8')
+    newlines = text.count("\n")
+    if newlines:
+        return stop, line + newlines, len(text) - text.rfind("\n") - 1
+    return stop, line, column + len(text)
+
+
+def _positioned_copy(elem):
+    """ A copy of elem's subtree in which the elements a transform added (plain
+        Elements without a position) map to where their closest parsed ancestor started
+    """
+    root = None
+    pending = [(elem, None, elem._start_line_number, elem._start_column_number)]
+    while pending:
+        node, parent, line, column = pending.pop()
+        copy = PositionedElement(node.tag, node.attrib)
+        copy.text = node.text
+        copy.tail = node.tail
+        if getattr(node, '_start_line_number', None) is None:
+            copy._start_line_number = copy._end_line_number = line
+            copy._start_column_number = copy._end_column_number = column
+        else:
+            copy._start_line_number = line = node._start_line_number
+            copy._start_column_number = column = node._start_column_number
+            copy._end_line_number = node._end_line_number
+            copy._end_column_number = node._end_column_number
+        if parent is None:
+            root = copy
+        else:
+            parent.append(copy)
+        pending.extend((child, copy, line, column) for child in reversed(node))
+    return root
+
+
+def _serialize_dirty(out, elem):
+    """ Serialize elem's subtree (not its tail) for splice_tree """
+    for node in elem.iter():
+        if getattr(node, '_start_line_number', None) is None:
+            elem = _positioned_copy(elem)
+            break
+    # declare elem's own namespace as the default one, like the source most likely did
+    # (attributes do not take the default namespace, so not if one of them uses it)
+    qnames, namespaces = _namespaces(elem)
+    tag = elem.tag
+    if isinstance(tag, str) and tag[:1] == "{":
+        prefix = "{" + tag[1:].partition("}")[0] + "}"
+        if not any(getattr(key, 'text', key).startswith(prefix)
+                   for node in elem.iter() for key in node.keys()):
+            namespaces[prefix[1:-1]] = ""
+            for qname in qnames:
+                if qname is not None and qname.startswith(prefix):
+                    qnames[qname] = qname[len(prefix):]
+    tail = elem.tail
+    elem.tail = None
+    try:
+        _serialize_xml(out, elem, qnames, namespaces, short_empty_elements=True)
+    finally:
+        elem.tail = tail
 
-def convert_file(html_in, html_out, source_map, source_map_input):
-    # html_parser = etree.HTMLParser(encoding="utf-8")
-    html_parser = LineNumberingParser(encoding="utf-8")
-    html_doc = ET.parse(html_in, html_parser)
-    # # html_doc = etree.XML(html_in.read(), html_parser)
-    # oven = Oven(css_in, use_repeatable_ids)
-    # oven.bake(html_doc, last_step)
 
+# Mapping granularities of splice_tree: a mapping at each copied line, or
+# (like writeXML) at each element
+SPLICE_GRANULARITIES = ('line', 'element')
+
+
+def _outermost(dirty):
+    """ The dirty elements that are not inside other dirty ones, in document order """
+    for elem in dirty:
+        if getattr(elem, '_start_byte_index', None) is None:
+            raise ValueError("%r was not parsed from the source; mark its parent "
+                             "dirty instead" % (elem,))
+    end = -1
+    for elem in sorted(dirty, key=operator.attrgetter('_start_byte_index')):
+        if elem._start_byte_index >= end:
+            end = elem._end_byte_index
+            yield elem
+
+
+def _splice(out, root, source, dirty, granularity='element'):
+    """ Write source to out with the dirty elements of root serialized again;
+        see splice_tree
+    """
+    view = memoryview(source)
+    smap = out._smap
+    source_idx = out.source_idx
+    # mappings of the span being copied, added right before its text
+    gen_lines = array('i')
+    gen_cols = array('i')
+    orig_lines = array('i')
+    orig_cols = array('i')
+    add_gen_line = gen_lines.append
+    add_gen_col = gen_cols.append
+    add_orig_line = orig_lines.append
+    add_orig_col = orig_cols.append
+    # the copied span starts at this byte index and original line/column, which
+    # map to the generated line/column it is written at; copying moves all lines
+    # by the same amount and the columns of the first line only
+    start = 0
+    first_line = 1
+    first_column = 0
+    line_delta = column_delta = 0
+
+    def begin():
+        add_gen_line(out.line)
+        add_gen_col(out.column)
+        add_orig_line(first_line)
+        add_orig_col(first_column)
+
+    def copy(stop):
+        out.flush()
+        text = str(view[start:stop], 'utf-8')
+        if text:
+            newlines = text.count("\n")
+            if newlines and granularity == 'line':
+                gen_lines.extend(range(out.line + 1, out.line + newlines + 1))
+                orig_lines.extend(range(first_line + 1, first_line + newlines + 1))
+                zeros = array('i', [0]) * newlines
+                gen_cols.extend(zeros)
+                orig_cols.extend(zeros)
+            smap.extend_raw(gen_lines, gen_cols, source_idx, orig_lines, orig_cols)
+            out.write_unmapped(text)
+        for column in (gen_lines, gen_cols, orig_lines, orig_cols):
+            del column[:]
+
+    def replace(elem):
+        nonlocal start, first_line, first_column, line_delta, column_delta
+        copy(elem._start_byte_index)
+        _serialize_dirty(out, elem)
+        start, first_line, first_column = _markup_end(source, elem)
+        line_delta = out.line - first_line
+        column_delta = out.column - first_column
+        begin()
+
+    begin()
+    if granularity == 'line':
+        for elem in _outermost(dirty):
+            replace(elem)
+        copy(len(source))
+        return
+
+    stack = [root]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        elem = pop()
+        if type(elem) is tuple:
+            # the end tag of a copied element
+            line = elem[0]._end_line_number
+            column = elem[0]._end_column_number
+        elif elem in dirty:
+            if getattr(elem, '_start_byte_index', None) is None:
+                raise ValueError("%r was not parsed from the source; mark its parent "
+                                 "dirty instead" % (elem,))
+            replace(elem)
+            continue
+        else:
+            line = elem._start_line_number
+            column = elem._start_column_number
+            end = elem._end_byte_index
+            if len(elem) or elem.text or source[end - 2:end] != b'/>':
+                push((elem,))
+                stack.extend(reversed(elem))
+        add_gen_line(line + line_delta)
+        add_gen_col(column + column_delta if line == first_line else column)
+        add_orig_line(line)
+        add_orig_col(column)
+    copy(len(source))
+
+
+def splice_tree(input_filename, root, source, html_out, dirty=(), consumer=None,
+                granularity='element', profiler=None, sources_content=None):
+    """ Write source, the bytes (or str) root was parsed from by LineNumberingParser,
+        copying it verbatim (attribute order, comments, empty elements and all)
+        except for the dirty elements, which are serialized again from the tree.
+        Return the SourceMapGenerator: the copied text is mapped by offset, at
+        the start and end tag of each element ("element", like writeXML) or only
+        at the start of each line ("line", which does not walk the tree and runs
+        close to the speed of copying the file); the serialized elements are
+        mapped like writeXML maps them.
+
+        dirty holds the elements a transform changed (attributes, text or
+        children). Changing the tail of an element, or adding or removing one,
+        makes its parent dirty.
+        consumer, profiler and sources_content are as for convert_tree.
+    """
+    if granularity not in SPLICE_GRANULARITIES:
+        raise ValueError('Unknown splice granularity: %r' % (granularity,))
+    stage = profiler.stage if profiler is not None else _no_stage
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    if not isinstance(dirty, (set, frozenset)):
+        dirty = set(dirty)
     smap = SourceMapGenerator()
 
-    # serialize out HTML
-    # print(etree.tostring(html_doc, method="html"), file=html_out)
-    writeXML(html_in.name, smap, html_doc.getroot(), html_out)
+    with stage('splice'):
+        with _get_writer(html_out, "unicode") as write:
+            out = MappedWriter(write, smap, smap.add_source(input_filename))
+            _splice(out, root, source, dirty, granularity)
+            out.flush()
+
+    if consumer is not None:
+        with stage('apply source map input'):
+            smap.apply_source_map(consumer, input_filename)
+    if sources_content is not None:
+        with stage('embed sources'):
+            _embed_sources(smap, sources_content, input_filename, source, consumer)
+    return smap
+
+
+_tool_version = None
+
+
+def _get_tool_version():
+    """ A hash of this file, so cached outputs of an older version are not used """
+    global _tool_version
+    if _tool_version is None:
+        with open(os.path.abspath(__file__), 'rb') as f:
+            _tool_version = hashlib.sha256(f.read()).hexdigest()
+    return _tool_version
+
+
+class BuildCache(object):
+    """ Converted outputs (HTML and sourcemap) kept on disk between builds.
+
+        An entry is keyed by a hash of everything that goes into the outputs: the
+        input name and bytes, the --source-map-input bytes, the options and the
+        version of this file. It is the directory <directory>/<key[:2]>/<key>
+        holding "html" and "map". Entries are written to a temporary directory and
+        renamed into place, so concurrent batch workers never see half an entry
+        (when two store the same key, the first rename wins).
+
+        A hit copies the files to the outputs, or hardlinks them with link=True
+        (then the outputs must not be modified in place, which would change the
+        entry too). Hits touch the entry, and prune() removes the least recently
+        used entries until the cache is no larger than max_bytes.
+    """
+    # Temporary directories older than this were left by a worker that died
+    STALE_SECONDS = 3600
+
+    def __init__(self, directory, max_bytes=1 << 30, link=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def key(self, *parts):
+        """ The key for parts (bytes, str, None or JSON-serializable objects) """
+        digest = hashlib.sha256(_get_tool_version().encode('ascii'))
+        for part in parts:
+            if part is None:
+                part = b''
+            elif isinstance(part, str):
+                part = part.encode('utf-8')
+            elif not isinstance(part, bytes):
+                part = json.dumps(part, sort_keys=True).encode('utf-8')
+            digest.update(b'%d:' % len(part))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _place(self, cached, target):
+        # never write onto target itself: it may be a hardlink into another entry
+        # (left by an earlier run with link=True)
+        temporary = '%s.%d.tmp' % (target, os.getpid())
+        try:
+            if self.link:
+                os.link(cached, temporary)
+            else:
+                shutil.copyfile(cached, temporary)
+            os.replace(temporary, target)
+        finally:
+            if os.path.lexists(temporary):
+                os.unlink(temporary)
+
+    def fetch(self, key, html_out, source_map):
+        """ Put the cached outputs for key at html_out and source_map; False when
+            there are none
+        """
+        entry = self._entry(key)
+        try:
+            self._place(os.path.join(entry, 'html'), html_out)
+            self._place(os.path.join(entry, 'map'), source_map)
+            os.utime(entry)
+        except OSError:
+            # not cached, or evicted while we were copying it
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def store(self, key, html_out, source_map):
+        """ Keep the outputs at html_out and source_map as the entry for key """
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        parent = os.path.dirname(entry)
+        os.makedirs(parent, exist_ok=True)
+        temporary = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+        try:
+            shutil.copyfile(html_out, os.path.join(temporary, 'html'))
+            shutil.copyfile(source_map, os.path.join(temporary, 'map'))
+            os.rename(temporary, entry)
+            self.stores += 1
+        except OSError:
+            pass
+        finally:
+            if os.path.isdir(temporary):
+                shutil.rmtree(temporary, ignore_errors=True)
+
+    def _entries(self):
+        """ [(last use, size, path)] of every entry; removes stale temporary directories """
+        entries = []
+        now = time.time()
+        try:
+            buckets = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for bucket in buckets:
+            bucket = os.path.join(self.directory, bucket)
+            if not os.path.isdir(bucket):
+                continue
+            for name in os.listdir(bucket):
+                path = os.path.join(bucket, name)
+                try:
+                    mtime = os.stat(path).st_mtime
+                    if name.startswith('.'):
+                        if now - mtime > self.STALE_SECONDS:
+                            shutil.rmtree(path, ignore_errors=True)
+                        continue
+                    size = sum(os.stat(os.path.join(path, f)).st_size for f in ('html', 'map'))
+                except OSError:
+                    continue
+                entries.append((mtime, size, path))
+        return entries
+
+    def prune(self):
+        """ Remove least recently used entries until the cache fits in max_bytes;
+            returns how many were removed
+        """
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        removed = 0
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            # out of sight first, so nobody copies half a removed entry
+            doomed = os.path.join(os.path.dirname(path), '.tmp-evicted-%d-%s' % (
+                os.getpid(), os.path.basename(path)))
+            try:
+                os.rename(path, doomed)
+            except OSError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+            size -= entry_size
+            removed += 1
+        return removed
+
+    def stats(self):
+        entries = self._entries()
+        return {'entries': len(entries), 'size': sum(entry[1] for entry in entries),
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                'stores': self.stores}
+
+
+# convert_file options that do not change the outputs
+_UNCACHED_OPTIONS = ('profiler', 'debug')
+
+
+def convert_file_cached(cache, html_in, html_out, source_map, source_map_input=None, **options):
+    """ convert_file by file names, through cache (a BuildCache): the outputs are
+        taken from the cache when the same input was converted the same way before.
+        Returns True for a cache hit.
+    """
+    with open(html_in, 'rb') as f:
+        source = f.read()
+    map_input = None
+    if source_map_input is not None:
+        with open(source_map_input, 'rb') as f:
+            map_input = f.read()
+    embedded = None
+    if options.get('sources_content') and map_input is not None:
+        # the texts of the sources the input map does not embed are read from disk
+        # (see SourceMapGenerator.add_sources_content), they are part of the output
+        consumer = SourceMapConsumer.from_file(io.BytesIO(map_input))
+        embedded = [(name, _source_contents.read(name)) for name in consumer.sources
+                    if consumer.source_content_for(name) is None]
+    key = cache.key(html_in, source, map_input,
+                    dict((k, v) for k, v in options.items() if k not in _UNCACHED_OPTIONS),
+                    embedded)
+    if cache.fetch(key, html_out, source_map):
+        return True
+    # the outputs may be hardlinks into the cache (from this or an earlier run
+    # with link=True), do not write through them
+    for path in (html_out, source_map):
+        if os.path.lexists(path):
+            os.unlink(path)
+    with contextlib.ExitStack() as stack:
+        map_in = None
+        if source_map_input is not None:
+            map_in = stack.enter_context(open(source_map_input))
+        convert_file(stack.enter_context(open(html_in)),
+                     stack.enter_context(open(html_out, 'w')),
+                     stack.enter_context(open(source_map, 'w')),
+                     map_in, **options)
+    cache.store(key, html_out, source_map)
+    return False
+
+
+def _convert_job(job):
+    """ Run convert_file for one (html_in, html_out, source_map, source_map_input, options)
+        job of a batch, options being keyword arguments for convert_file, plus 'cache'
+        (a BuildCache, or None).
+        Returns (html_in, seconds, error, cache hit) where error is None or a traceback.
+        Never raises so one bad file does not abort the batch.
+    """
+    html_in, html_out, source_map, source_map_input, options = job
+    options = dict(options)
+    cache = options.pop('cache', None)
+    start = time.time()
+    hit = False
+    try:
+        if cache is not None:
+            hit = convert_file_cached(cache, html_in, html_out, source_map, source_map_input,
+                                      **options)
+        else:
+            with contextlib.ExitStack() as stack:
+                map_in = None
+                if source_map_input is not None:
+                    map_in = stack.enter_context(open(source_map_input))
+                convert_file(stack.enter_context(open(html_in)),
+                             stack.enter_context(open(html_out, 'w')),
+                             stack.enter_context(open(source_map, 'w')),
+                             map_in, **options)
+    except Exception:
+        return html_in, time.time() - start, traceback.format_exc(), hit
+    return html_in, time.time() - start, None, hit
+
+
+def _read_manifest(manifest):
+    """ Jobs from a manifest file. Each line is
+            html_in html_out [source_map [source_map_input]]
+        source_map defaults to html_out + ".map". Blank lines and lines starting with # are skipped.
+    """
+    jobs = []
+    for line in manifest:
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        if len(fields) > 4:
+            raise ValueError("Too many fields in manifest line: %r" % line)
+        html_in, html_out = fields[:2]
+        source_map = fields[2] if len(fields) > 2 else html_out + '.map'
+        source_map_input = fields[3] if len(fields) > 3 else None
+        jobs.append((html_in, html_out, source_map, source_map_input))
+    return jobs
+
+
+def _glob_base(pattern):
+    """ The leading directories of pattern that contain no wildcards """
+    base = os.path.dirname(pattern)
+    while glob.has_magic(base):
+        base = os.path.dirname(base)
+    return base or os.curdir
+
+
+def batch_main(argv):
+    """Convert many files in parallel (main.py batch --jobs N manifest.txt)."""
+    parser = argparse.ArgumentParser(prog="main.py batch",
+                                     description="Convert many files with a pool of processes")
+    parser.add_argument("manifest", nargs='?',
+                        type=argparse.FileType('r'),
+                        help="file with one 'html_in html_out [output.map [input.map]]' per line")
+    parser.add_argument('--glob', metavar='PATTERN',
+                        help="convert every file matching PATTERN into --out-dir instead "
+                             "(an existing html_in.map is used as --source-map-input)")
+    parser.add_argument('--out-dir', metavar='DIR',
+                        help="directory for the outputs of --glob, which keep their path "
+                             "below the part of PATTERN without wildcards")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('--chunksize', type=int,
+                        help="files handed to a worker at a time (default: spread evenly)")
+    parser.add_argument('--stream', action='store_true',
+                        help="use the streaming serializer")
+    parser.add_argument('--splice', action='store_true',
+                        help="see main.py --help")
+    parser.add_argument('--map-granularity', choices=MAP_GRANULARITIES + ('line',),
+                        default='element', help="see main.py --help")
+    parser.add_argument('--map-names', action='store_true',
+                        help="see main.py --help")
+    parser.add_argument('--simplify-map', choices=MAP_SIMPLIFICATIONS, default='none',
+                        help="see main.py --help")
+    parser.add_argument('--sources-content', action='store_true',
+                        help="see main.py --help; each worker reads a source once")
+    parser.add_argument('--cache', metavar='DIR',
+                        help="reuse the outputs of files converted the same way before "
+                             "(see main.py --help)")
+    parser.add_argument('--cache-mb', type=float, default=1024,
+                        help="size the cache is pruned to after the batch (default 1024)")
+    parser.add_argument('--cache-link', action='store_true',
+                        help="hardlink cached outputs instead of copying them")
+    args = parser.parse_args(argv)
+
+    if args.glob:
+        if args.manifest or not args.out_dir:
+            parser.error("--glob needs --out-dir and no manifest")
+        # outputs keep their path below the directories of the pattern without wildcards
+        base = _glob_base(args.glob)
+        jobs = []
+        for html_in in sorted(glob.glob(args.glob)):
+            html_out = os.path.join(args.out_dir, os.path.relpath(html_in, base))
+            source_map_input = html_in + '.map'
+            if not os.path.exists(source_map_input):
+                source_map_input = None
+            jobs.append((html_in, html_out, html_out + '.map', source_map_input))
+    elif args.manifest:
+        jobs = _read_manifest(args.manifest)
+    else:
+        parser.error("either a manifest or --glob is required")
+    # outputs are truncated by the first worker that gets to them
+    inputs = set(os.path.realpath(path) for job in jobs for path in (job[0], job[3]) if path)
+    outputs = set()
+    for job in jobs:
+        for path in job[1:3]:
+            real = os.path.realpath(path)
+            if real in inputs:
+                parser.error("%s would overwrite an input" % path)
+            if real in outputs:
+                parser.error("%s is the output of more than one file" % path)
+            outputs.add(real)
+    for directory in set(os.path.dirname(job[1]) for job in jobs):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+    if args.splice and (args.stream or args.map_granularity not in SPLICE_GRANULARITIES):
+        parser.error("--splice cannot be combined with --stream and maps by element or line")
+    if args.map_granularity == 'line' and not args.splice:
+        parser.error("--map-granularity line needs --splice")
+    options = {'stream': args.stream, 'granularity': args.map_granularity,
+               'attribute_names': args.map_names, 'simplify': args.simplify_map,
+               'splice': args.splice, 'sources_content': args.sources_content}
+    cache = None
+    if args.cache:
+        cache = options['cache'] = BuildCache(args.cache, int(args.cache_mb * 1024 * 1024),
+                                              link=args.cache_link)
+    jobs = [job + (options,) for job in jobs]
+
+    start = time.time()
+    failures = 0
+    hits = 0
+    if args.jobs <= 1 or len(jobs) <= 1:
+        results = map(_convert_job, jobs)
+        executor = None
+    else:
+        chunksize = args.chunksize or max(1, len(jobs) // (args.jobs * 4))
+        executor = concurrent.futures.ProcessPoolExecutor(args.jobs)
+        results = executor.map(_convert_job, jobs, chunksize=chunksize)
+    try:
+        for html_in, seconds, error, hit in results:
+            hits += hit
+            if error is None:
+                print("%s %8.3fs %s" % ("hit " if hit else "ok  ", seconds, html_in))
+            else:
+                failures += 1
+                print("FAIL %8.3fs %s" % (seconds, html_in))
+                print(error, file=sys.stderr)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print("%d converted, %d failed in %.3fs" % (len(jobs) - failures, failures, time.time() - start))
+    if cache is not None:
+        cache.prune()
+        stats = cache.stats()
+        print("cache: %d hits, %d misses, %d entries, %.1f MB" % (
+            hits, len(jobs) - hits, stats['entries'], stats['size'] / 1e6))
+    return 1 if failures else 0
+
+
+def lookup_main(argv):
+    """Print the original position of generated positions (main.py lookup out.html.map LINE:COLUMN ...)."""
+    parser = argparse.ArgumentParser(prog="main.py lookup",
+                                     description="Look up original positions in a sourcemap")
+    parser.add_argument("source_map", metavar='output.map',
+                        help="Sourcemap file to read")
+    parser.add_argument("positions", metavar='LINE:COLUMN', nargs='+',
+                        help="generated line (1-based) and column (0-based)")
+    parser.add_argument('-C', '--context', type=int, metavar='LINES',
+                        help="also print the original line and LINES lines around it, "
+                             "from the sources embedded in the sourcemap")
+    args = parser.parse_args(argv)
+
+    try:
+        # only decodes the lines that are looked up
+        consumer = LazySourceMapConsumer(args.source_map)
+    except ValueError:
+        consumer = SourceMapConsumer.from_file(args.source_map)
+    positions = []
+    for position in args.positions:
+        line, _, column = position.rpartition(':')
+        positions.append((int(line), int(column)))
+    originals = consumer.lookup_many(positions)
+    snippets = [None] * len(originals)
+    if args.context is not None:
+        snippets = source_snippets(consumer, originals, args.context)
+    for (line, column), original, snippet in zip(positions, originals, snippets):
+        print("{0}:{1} -> {2[source]}:{2[line]}:{2[column]}".format(line, column, original))
+        if snippet is not None:
+            first = max(original['line'] - args.context, 1)
+            for number, text in enumerate(snippet, first):
+                print("%s%5d| %s" % (">" if number == original['line'] else " ", number, text))
+
+
+class LRUCache(object):
+    """ Least recently used cache bounded by the total size of its values.
+        Sizes are whatever the caller says they are (an estimate in bytes).
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.budget:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.budget:
+                self.size -= self._entries.popitem(last=False)[1][1]
+
+    def stats(self):
+        return {'entries': len(self._entries), 'size': self.size, 'budget': self.budget,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def _content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class SourceContentCache(object):
+    """ The text of source files for sourcesContent, read once per process and
+        shared by all the sourcemaps that embed them (a batch worker or the
+        server converts many files that map to the same sources).
+
+        A path is only read again when its size or modification time changed.
+        The texts are kept in an LRUCache under the hash of their content, so the
+        same text reached through several paths, or handed in with add(), is
+        held once.
+    """
+    BUDGET = 256 * 1024 * 1024
+
+    def __init__(self, budget=BUDGET):
+        self.reads = 0
+        self._texts = LRUCache(budget)
+        # path -> (size, modification time, content hash)
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _add(self, text):
+        key = _content_hash(text)
+        shared = self._texts.get(key)
+        if shared is None:
+            self._texts.put(key, text, len(text))
+            shared = text
+        return key, shared
+
+    def add(self, text):
+        """ The shared copy of text (a str, or UTF-8 bytes) """
+        if not isinstance(text, str):
+            text = str(text, 'utf-8')
+        return self._add(text)[1]
+
+    def read(self, path):
+        """ The text of the file at path, or None when it cannot be read as UTF-8 """
+        try:
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        version = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            known = self._files.get(path)
+        if known is not None and known[:2] == version:
+            text = self._texts.get(known[2])
+            if text is not None:
+                return text
+        try:
+            with open(path, 'rb') as f:
+                text = f.read().decode('utf-8')
+        except (OSError, UnicodeDecodeError):
+            return None
+        self.reads += 1
+        key, text = self._add(text)
+        with self._lock:
+            self._files[path] = version + (key,)
+        return text
+
+    def stats(self):
+        stats = self._texts.stats()
+        stats['reads'] = self.reads
+        return stats
+
+
+# The SourceContentCache of this process
+_source_contents = SourceContentCache()
+
+
+class ConversionServer(object):
+    """ Keep convert_file warm between requests (main.py serve).
+
+        Requests and responses are one JSON object per line:
+          {"op": "convert", "source": "input.html", "html": "...", "source_map_input": "{...}",
+           "sources_content": false}
+            -> {"ok": true, "html": "...", "map": "{...}", "key": "...", "cached": false}
+          {"op": "lookup", "key": "...", "positions": [[1, 0], ...], "context": 0}
+           (or "map": "{...}" instead of key; "context" is optional)
+            -> {"ok": true, "positions": [{"source": .., "line": .., "column": .., "name": ..}, ...],
+                "snippets": [["original line", ...] or null, ...]}
+          {"op": "stats"} -> {"ok": true, "cache": {...}, "fragments": {...}, "sources": {...}}
+        Parsed trees, conversion results and SourceMapConsumers are kept in one
+        LRUCache keyed by a hash of their content. Conversions run in a thread so
+        cached requests are answered while a conversion is in progress.
+        The FragmentCache of the last conversion of each source is kept too, so
+        converting an edited document only serializes the subtrees that changed.
+        With "sources_content" the map embeds the sources (the html itself and
+        the files the input map points to, read once through the process's
+        SourceContentCache); lookups with a "context" answer with the original
+        lines from there, decoding an embedded source only when it is first needed.
+    """
+    # A parsed tree takes roughly this many times the size of its source
+    TREE_SIZE_FACTOR = 10
+    CONSUMER_SIZE_FACTOR = 4
+    # Number of sources to keep a FragmentCache for
+    FRAGMENT_SOURCES = 16
+
+    def __init__(self, cache_budget):
+        self.cache = LRUCache(cache_budget)
+        self._fragments = collections.OrderedDict()
+        self._fragments_lock = threading.Lock()
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+
+    def _tree(self, html):
+        key = ('tree', _content_hash(html))
+        root = self.cache.get(key)
+        if root is None:
+            html_parser = LineNumberingParser(encoding="utf-8")
+            html_parser.feed(html)
+            root = html_parser.close()
+            self.cache.put(key, root, len(html) * self.TREE_SIZE_FACTOR)
+        return root
+
+    def _consumer(self, key, source_map):
+        key = ('consumer', key)
+        consumer = self.cache.get(key)
+        if consumer is None:
+            # embedded sources stay encoded until a lookup asks for them
+            consumer = load_source_map(_json_map(source_map.encode('utf-8')))
+            self.cache.put(key, consumer, len(source_map) * self.CONSUMER_SIZE_FACTOR)
+        return consumer
+
+    def _convert(self, source, html, source_map_input, sources_content=False):
+        consumer = None
+        if source_map_input:
+            consumer = self._consumer(_content_hash(source_map_input), source_map_input)
+        # take the source's FragmentCache so concurrent conversions do not share one
+        with self._fragments_lock:
+            fragments = self._fragments.pop(source, None)
+        if fragments is None:
+            fragments = FragmentCache()
+        hits, misses = fragments.hits, fragments.misses
+        out = io.StringIO()
+        smap = convert_tree(source, self._tree(html), out, consumer, html, fragments,
+                            sources_content=_source_contents if sources_content else None)
+        with self._fragments_lock:
+            self.fragment_hits += fragments.hits - hits
+            self.fragment_misses += fragments.misses - misses
+            self._fragments[source] = fragments
+            while len(self._fragments) > self.FRAGMENT_SOURCES:
+                self._fragments.popitem(last=False)
+        return out.getvalue(), smap.to_json()
+
+    async def convert(self, request):
+        source = request.get('source', 'input.html')
+        html = request['html']
+        source_map_input = request.get('source_map_input')
+        sources_content = bool(request.get('sources_content'))
+        key = _content_hash(source, html, source_map_input)
+        if sources_content:
+            key = _content_hash(key, 'sources_content')
+        result = self.cache.get(('result', key))
+        cached = result is not None
+        if not cached:
+            loop = asyncio.get_event_loop()
+            result = await loop.run_in_executor(None, self._convert, source, html, source_map_input,
+                                                sources_content)
+            self.cache.put(('result', key), result, len(result[0]) + len(result[1]))
+        return {'html': result[0], 'map': result[1], 'key': key, 'cached': cached}
+
+    async def lookup(self, request):
+        if 'key' in request:
+            key = request['key']
+            consumer = self.cache.get(('consumer', key))
+            if consumer is None:
+                result = self.cache.get(('result', key))
+                if result is None:
+                    raise KeyError('Unknown or evicted key: %s' % key)
+                source_map = result[1]
+        else:
+            source_map = request['map']
+            key = _content_hash(source_map)
+            consumer = self.cache.get(('consumer', key))
+        if consumer is None:
+            loop = asyncio.get_event_loop()
+            consumer = await loop.run_in_executor(None, self._consumer, key, source_map)
+        positions = [(line, column) for line, column in request['positions']]
+        originals = consumer.lookup_many(positions)
+        response = {'positions': originals}
+        if request.get('context') is not None:
+            response['snippets'] = source_snippets(consumer, originals, request['context'])
+        return response
+
+    async def stats(self, request):
+        return {'cache': self.cache.stats(),
+                'fragments': {'sources': len(self._fragments),
+                              'hits': self.fragment_hits, 'misses': self.fragment_misses},
+                'sources': _source_contents.stats()}
+
+    async def handle(self, reader, writer):
+        """ Answer the requests of one connection """
+        ops = {'convert': self.convert, 'lookup': self.lookup, 'stats': self.stats}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    response = await ops[request['op']](request)
+                    response['ok'] = True
+                except Exception as e:
+                    response = {'ok': False, 'error': '%s: %s' % (e.__class__.__name__, e)}
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def serve_main(argv):
+    """Run a conversion server (main.py serve --socket PATH | --port N)."""
+    parser = argparse.ArgumentParser(prog="main.py serve",
+                                     description="Serve conversions and lookups from a warm process")
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--socket', metavar='PATH', help="listen on a Unix socket")
+    where.add_argument('--port', type=int, help="listen on localhost:PORT")
+    parser.add_argument('--cache-mb', type=float, default=256,
+                        help="memory budget for cached trees, results and maps (default 256)")
+    args = parser.parse_args(argv)
+
+    server = ConversionServer(int(args.cache_mb * 1024 * 1024))
+
+    async def run():
+        if args.socket:
+            listener = await asyncio.start_unix_server(server.handle, path=args.socket, limit=1 << 30)
+        else:
+            listener = await asyncio.start_server(server.handle, host='127.0.0.1', port=args.port,
+                                                  limit=1 << 30)
+        print("listening on %s" % (args.socket or '127.0.0.1:%d' % args.port), file=sys.stderr)
+        async with listener:
+            await listener.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
 
-    print("SOURCEMAP_STR", str(smap))
-    print(smap.to_json(), file=source_map)
+def _read_source_map(filename):
+    """ The sourcemap in filename, JSON or binary, as a dict """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:len(BINARY_MAP_MAGIC)] == BINARY_MAP_MAGIC:
+        data = binary_map_to_json(data)
+    return json.loads(data)
+
+
+def concat_main(argv):
+    """Join converted files and merge their sourcemaps (main.py concat out.html a.html:a.map ...)."""
+    parser = argparse.ArgumentParser(prog="main.py concat",
+                                     description="Concatenate converted files into one file "
+                                                 "with one sourcemap")
+    parser.add_argument("html_out", metavar='out.html', help="concatenated output")
+    parser.add_argument("parts", metavar='FILE[:MAP]', nargs='+',
+                        help="converted files in order, each with its sourcemap "
+                             "(default FILE.map when it exists, otherwise the file is unmapped)")
+    parser.add_argument('--source-map', metavar='output.map',
+                        help="merged sourcemap (default out.html.map)")
+    args = parser.parse_args(argv)
+
+    concat = SourceMapConcatenator(os.path.basename(args.html_out))
+    with open(args.html_out, 'w', newline='') as html_out:
+        for part in args.parts:
+            html_in, _, map_in = part.rpartition(':')
+            if not html_in:
+                html_in = map_in
+                map_in = html_in + '.map'
+                if not os.path.exists(map_in):
+                    map_in = None
+            # newline='': columns count the characters that are really there
+            with open(html_in, newline='') as f:
+                text = f.read()
+            html_out.write(text)
+            concat.add(text, _read_source_map(map_in) if map_in else None)
+    with open(args.source_map or args.html_out + '.map', 'w') as f:
+        print(concat.to_json(), file=f)
+
+
+def convert_map_main(argv):
+    """Convert a sourcemap between JSON and the binary format (main.py convert-map in.map out.map)."""
+    parser = argparse.ArgumentParser(prog="main.py convert-map",
+                                     description="Convert a v3 sourcemap to a binary sourcemap, "
+                                                 "or a binary sourcemap back to JSON")
+    parser.add_argument("map_in", metavar='input.map', help="JSON or binary sourcemap")
+    parser.add_argument("map_out", metavar='output.map',
+                        help="the other format (binary for a JSON input and vice versa)")
+    args = parser.parse_args(argv)
+
+    with open(args.map_in, 'rb') as f:
+        data = f.read()
+    if data[:len(BINARY_MAP_MAGIC)] == BINARY_MAP_MAGIC:
+        with open(args.map_out, 'w') as f:
+            print(binary_map_to_json(data), file=f)
+    else:
+        with open(args.map_out, 'wb') as f:
+            f.write(json_map_to_binary(json.loads(data)))
+
+
+SUBCOMMANDS = {
+    'batch': batch_main,
+    'concat': concat_main,
+    'convert-map': convert_map_main,
+    'lookup': lookup_main,
+    'serve': serve_main,
+}
+
+
+def _open_output(parser, path):
+    """ Open an output named on the command line like argparse.FileType('w') does """
+    try:
+        return argparse.FileType('w')(path)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
 
 
 def main(argv=None):
     """Commandline script wrapping Baker."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in SUBCOMMANDS:
+        return SUBCOMMANDS[argv[0]](argv[1:])
+
     parser = argparse.ArgumentParser(description="Process raw HTML to baked"
                                                  " (embedded numbering and"
                                                  " collation)")
@@ -627,22 +4461,102 @@ def main(argv=None):
                         type=argparse.FileType('r'),
                         help="raw HTML file to bake (default stdin)",
                         default=sys.stdin)
+    # the outputs are opened after parsing: with --cache they may be hardlinks
+    # into the cache, which must be unlinked and not truncated
     parser.add_argument("html_out",
-                        type=argparse.FileType('w'),
-                        help="baked HTML file output (default stdout)",
-                        default=sys.stdout)
+                        help="baked HTML file output (- for stdout)")
     parser.add_argument('--source-map-input', metavar='html.map',
                         type=argparse.FileType('r'),
                         help="HTML Sourcemap file if it exists ")
     parser.add_argument('--source-map', metavar='output.map',
-                        type=argparse.FileType('w'),
                         help="HTML Output Sourcemap file")
+    parser.add_argument('--stream', action='store_true',
+                        help="Serialize while parsing so memory does not grow "
+                             "with the size of the document")
+    parser.add_argument('--splice', action='store_true',
+                        help="Copy the input through verbatim instead of serializing it "
+                             "again, mapped by offset (with --map-granularity element or line)")
+    parser.add_argument('--map-granularity', choices=MAP_GRANULARITIES + ('line',),
+                        default='element',
+                        help="Map only elements (default), or also attributes, text runs "
+                             "and the tokens in text; each level adds mappings. With "
+                             "--splice: line maps only the start of each line")
+    parser.add_argument('--map-names', action='store_true',
+                        help="Name attribute mappings after the attribute "
+                             "(with --map-granularity attribute or finer)")
+    parser.add_argument('--simplify-map', choices=MAP_SIMPLIFICATIONS, default='none',
+                        help="Leave out the mappings that repeat the previous original "
+                             "position on a line (repeats; lookups do not change), and "
+                             "also those of whitespace-only text (whitespace)")
+    parser.add_argument('--source-map-format', choices=('json', 'binary'), default='json',
+                        help="json (default) or the binary format, which later passes "
+                             "load faster (--source-map-input reads either)")
+    parser.add_argument('--sources-content', action='store_true',
+                        help="Embed the text of the sources in the sourcemap (sourcesContent), "
+                             "so lookups do not need the files")
+    parser.add_argument('--index-map', metavar='LINES', type=int,
+                        help="Write the sourcemap as an index map with a section "
+                             "every LINES generated lines")
+    parser.add_argument('--cache', metavar='DIR',
+                        help="Build cache: copy the outputs from DIR when this input was "
+                             "converted the same way before, and keep them there otherwise")
+    parser.add_argument('--cache-mb', type=float, default=1024,
+                        help="size the cache is pruned to (default 1024)")
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Send debugging info to stderr')
+    parser.add_argument('--profile', metavar='FILE',
+                        help="Write the time, calls, output and mappings of each stage to FILE")
+    parser.add_argument('--profile-format', choices=('json', 'chrome'), default='json',
+                        help="json (default) or a Chrome trace-event file")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="Also record the allocation peak of each stage (slow)")
     args = parser.parse_args(argv)
+    if args.index_map is not None and args.index_map < 1:
+        parser.error("--index-map needs a positive number of lines")
+    if args.index_map and args.stream:
+        parser.error("--index-map cannot be combined with --stream")
+    if args.source_map_format == 'binary' and (args.index_map or args.stream):
+        parser.error("--source-map-format binary cannot be combined with --index-map or --stream")
+
+    if args.splice and (args.stream or args.map_granularity not in SPLICE_GRANULARITIES):
+        parser.error("--splice cannot be combined with --stream and maps by element or line")
+    if args.map_granularity == 'line' and not args.splice:
+        parser.error("--map-granularity line needs --splice")
 
-    convert_file(args.html_in, args.html_out, args.source_map, args.source_map_input)
+    if args.cache and (args.html_in is sys.stdin or args.html_out == '-'
+                       or args.source_map in (None, '-')):
+        parser.error("--cache needs html_in, html_out and --source-map files")
+
+    profiler = None
+    if args.profile:
+        profiler = Profiler(memory=args.profile_memory)
+    options = dict(stream=args.stream, index_map_lines=args.index_map,
+                   granularity=args.map_granularity, attribute_names=args.map_names,
+                   profiler=profiler, debug=args.debug,
+                   source_map_format=args.source_map_format, simplify=args.simplify_map,
+                   splice=args.splice, sources_content=args.sources_content)
+    with profiler.activate() if profiler is not None else _NO_STAGE:
+        if args.cache:
+            for f in (args.html_in, args.source_map_input):
+                if f is not None:
+                    f.close()
+            cache = BuildCache(args.cache, int(args.cache_mb * 1024 * 1024))
+            convert_file_cached(cache, args.html_in.name, args.html_out, args.source_map,
+                                args.source_map_input.name if args.source_map_input else None,
+                                **options)
+            cache.prune()
+        else:
+            html_out = _open_output(parser, args.html_out)
+            source_map = None
+            if args.source_map is not None:
+                source_map = _open_output(parser, args.source_map)
+            convert_file(args.html_in, html_out, source_map, args.source_map_input, **options)
+    if profiler is not None:
+        with open(args.profile, 'w') as f:
+            f.write(profiler.to_chrome_trace() if args.profile_format == 'chrome'
+                    else profiler.to_json())
+            f.write("\n")
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))